@@ -1,42 +1,145 @@
-import re
-import paramiko
-from typing import Optional, Tuple, List, Dict
 import io
+import queue
+import re
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator, Optional, Tuple, List, Dict
+
 import paramiko
 
+
 class SSHExecError(Exception):
     pass
 
 
-def _ssh_run(host: str, username: str, password: str, command: str, port: int = 22, timeout: int = 10) -> str:
+# ---------- Пул SSH-соединений ----------
+# Ключ (host, port, user) -> стек живых SSHClient. Рукопожатие + auth стоят сотни мс,
+# а хелперы ниже делают по несколько команд подряд — соединение переиспользуем.
+_POOL: Dict[tuple, "queue.LifoQueue[paramiko.SSHClient]"] = {}
+_POOL_LOCK = threading.Lock()
+_POOL_MAX = 4
+
+
+def _close_quietly(client: paramiko.SSHClient) -> None:
+    try:
+        client.close()
+    except Exception:
+        pass
+
+
+def _new_client(host: str, port: int, username: str, password: str, timeout: int) -> paramiko.SSHClient:
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(
+        hostname=host,
+        port=port,
+        username=username,
+        password=password,
+        timeout=timeout,
+        auth_timeout=timeout,
+    )
+    transport = client.get_transport()
+    if transport is not None:
+        transport.set_keepalive(30)  # чтобы NAT не обрывал простаивающее соединение
+    return client
+
+
+class _StaleClient(paramiko.SSHException):
+    """Соединение из пула не открыло канал: команда не ушла, можно повторить на новом."""
+
+
+@contextmanager
+def _borrow(host: str, port: int, username: str, password: str, timeout: int, fresh: bool = False):
+    """
+    Выдаёт (SSHClient, взят_из_пула) — из пула или новый (fresh=True — всегда новый).
+    После успешной работы возвращает его обратно; при сетевой/SSH-ошибке — закрывает
+    и выбрасывает.
+    """
+    with _POOL_LOCK:
+        pool = _POOL.setdefault((host, port, username), queue.LifoQueue(maxsize=_POOL_MAX))
+
+    client = None
+    while client is None and not fresh:
+        try:
+            cand = pool.get_nowait()
+        except queue.Empty:
+            break
+        transport = cand.get_transport()
+        if transport is not None and transport.is_active():
+            client = cand
+        else:
+            _close_quietly(cand)
+    reused = client is not None
+    if client is None:
+        client = _new_client(host, port, username, password, timeout)
+
     try:
-        client.connect(
-            hostname=host,
-            port=port,
-            username=username,
-            password=password,
-            timeout=timeout,
-            auth_timeout=timeout,
-        )
-        _, stdout, stderr = client.exec_command(command, timeout=timeout)
+        yield client, reused
+    except (paramiko.SSHException, socket.error, EOFError):
+        _close_quietly(client)
+        raise
+    except BaseException:
+        # ошибка не транспортная (например, SSHExecError) — соединение годно
+        _release(pool, client)
+        raise
+    else:
+        _release(pool, client)
+
+
+def _release(pool: "queue.LifoQueue[paramiko.SSHClient]", client: paramiko.SSHClient) -> None:
+    try:
+        pool.put_nowait(client)
+    except queue.Full:
+        _close_quietly(client)
+
+
+def _ssh_run(host: str, username: str, password: str, command: str, port: int = 22, timeout: int = 10,
+             stdin_data: Optional[str] = None) -> str:
+    try:
+        return _ssh_exec(host, username, password, command, port, timeout, stdin_data)
+    except _StaleClient:
+        # у пира/NAT соединение уже умерло, хотя транспорт считает себя живым — берём новое
+        return _ssh_exec(host, username, password, command, port, timeout, stdin_data, fresh=True)
+
+
+def _ssh_exec(host: str, username: str, password: str, command: str, port: int, timeout: int,
+              stdin_data: Optional[str], fresh: bool = False) -> str:
+    with _borrow(host, port, username, password, timeout, fresh=fresh) as (client, reused):
+        try:
+            stdin, stdout, stderr = client.exec_command(command, timeout=timeout)
+        except (paramiko.SSHException, socket.error, EOFError) as e:
+            if reused:
+                raise _StaleClient(str(e)) from e
+            raise
+        if stdin_data is not None:
+            stdin.write(stdin_data)
+            stdin.flush()
+            stdin.channel.shutdown_write()  # EOF для читающей stdin команды
         out = stdout.read().decode(errors="ignore")
         err = stderr.read().decode(errors="ignore")
-        if err and not out:
-            raise SSHExecError(err.strip()[:400])
-        return out
-    finally:
-        try:
-            client.close()
-        except Exception:
-            pass
+        rc = stdout.channel.recv_exit_status()
+    # ненулевой код — ошибка, даже если что-то успело попасть в stdout
+    # (mysql останавливается на первом упавшем запросе, но вывод предыдущих уже есть)
+    if rc != 0:
+        raise SSHExecError((err.strip() or out.strip() or f"exit status {rc}")[:400])
+    if err and not out:
+        raise SSHExecError(err.strip()[:400])
+    return out
+
+
+_SSH_SCHEME_RE = re.compile(r'^\s*ssh://', re.I)
+_HTTP_SCHEME_RE = re.compile(r'^\s*https?://', re.I)
 
 
+@lru_cache(maxsize=256)
 def _normalize_ssh_host(raw: str) -> Tuple[str, int]:
     s = raw.strip()
-    s = re.sub(r'^\s*ssh://', '', s, flags=re.I)
-    s = re.sub(r'^\s*https?://', '', s, flags=re.I)
+    s = _SSH_SCHEME_RE.sub('', s)
+    s = _HTTP_SCHEME_RE.sub('', s)
     s = s.strip().rstrip('/')
     if ':' in s:
         host, port_str = s.rsplit(':', 1)
@@ -48,30 +151,27 @@ def _normalize_ssh_host(raw: str) -> Tuple[str, int]:
 
 # ---------- Разбор вывода PJSIP ----------
 
-_CONTACT_RE = re.compile(
-    r"Contact:\s+\S+/sip:[^@\s]+@(?P<ip>\d{1,3}(?:\.\d{1,3}){3})(?::\d+)?\b",
-    re.IGNORECASE,
-)
-_MATCH_RE = re.compile(
-    r"Match:\s+(?P<ip>\d{1,3}(?:\.\d{1,3}){3})(?:/\d+)?",
+# Contact- и Match-строки одним проходом: группа c — IP из Contact, m — из Match
+_IP_RE = re.compile(
+    r"Contact:\s+\S+/sip:[^@\s]+@(?P<c>\d{1,3}(?:\.\d{1,3}){3})"
+    r"|Match:\s+(?P<m>\d{1,3}(?:\.\d{1,3}){3})(?:/\d+)?",
     re.IGNORECASE,
 )
 
 
 def parse_ips_from_endpoint(text: str) -> List[str]:
-    seen = set()
-    out: List[str] = []
-    for m in _CONTACT_RE.finditer(text):
-        ip = m.group("ip")
-        if ip not in seen:
-            seen.add(ip)
-            out.append(ip)
-    for m in _MATCH_RE.finditer(text):
-        ip = m.group("ip")
-        if ip not in seen:
-            seen.add(ip)
-            out.append(ip)
-    return out
+    # Contact-адреса идут раньше Match, дубли отбрасываются, порядок сохраняется
+    contacts: Dict[str, None] = {}
+    matches: Dict[str, None] = {}
+    for m in _IP_RE.finditer(text):
+        ip = m.group("c")
+        if ip:
+            contacts[ip] = None
+        else:
+            matches[m.group("m")] = None
+    for ip in matches:
+        contacts.setdefault(ip)
+    return list(contacts)
 
 
 def fetch_goip_ips_via_ssh(
@@ -93,20 +193,20 @@ def fetch_goip_ips_via_ssh(
         f'asterisk -rx "pjsip show contacts" | grep -i {endpoint_primary} || true',
     ]
 
+    # Команды независимы — запускаем сразу все, а результат берём по приоритету:
+    # первый по списку cmd, давший хоть один IP. Время — максимум, а не сумма.
+    with ThreadPoolExecutor(max_workers=len(cmds)) as pool:
+        futures = [pool.submit(_ssh_run, h, username, password, cmd, port=p, timeout=timeout) for cmd in cmds]
+
     ips: List[str] = []
-    for cmd in cmds:
+    for fut in futures:
         try:
-            out = _ssh_run(h, username, password, cmd, port=p, timeout=timeout)
+            out = fut.result()
         except Exception:
             continue
         if not out:
             continue
-        found = parse_ips_from_endpoint(out)
-        if not found and "contacts" in cmd.lower():
-            found = [m.group("ip") for m in _CONTACT_RE.finditer(out)]
-        for ip in found:
-            if ip not in ips:
-                ips.append(ip)
+        ips = parse_ips_from_endpoint(out)
         if ips:
             break
 
@@ -124,10 +224,13 @@ def fetch_pjsip_endpoints_via_ssh(
         h, username, password, 'asterisk -rx "pjsip show endpoints"', port=p, timeout=timeout
     )
     names = []
-    for line in out.splitlines():
-        m = re.search(r'^\s*Endpoint:\s+(\S+)', line, flags=re.I)
-        if m:
-            names.append(m.group(1))
+    for line in out.split("\n"):
+        # строки вида "  Endpoint:  101/101  Not in use ..." — regex здесь не нужен
+        st = line.lstrip()
+        if st[:9].lower() == "endpoint:":
+            fields = st.split(None, 2)
+            if len(fields) > 1:
+                names.append(fields[1])
     return names
 
 
@@ -141,20 +244,24 @@ def fetch_endpoint_raw_via_ssh(
     return _ssh_run(h, username, password, cmd, port=p, timeout=timeout)
 
 def _sftp_open_ro(sftp: paramiko.SFTPClient, path: str) -> Optional[io.BytesIO]:
+    # getfo пишет прямо в буфер и читает с prefetch — без промежуточной копии f.read()
+    buf = io.BytesIO()
     try:
-        with sftp.file(path, "rb") as f:
-            return io.BytesIO(f.read())
+        sftp.getfo(path, buf)
     except FileNotFoundError:
         return None
+    buf.seek(0)
+    return buf
     
 
 def _ssh_run_mysql_single(host: str, username: str, password: str, sql: str,
                           port: int = 22, timeout: int = 10) -> str:
     """
-    Выполнить один SQL-запрос на FreePBX-хосте через mysql CLI.
+    Выполнить SQL (один запрос или скрипт) на FreePBX-хосте через mysql CLI.
     Берём AMPDB-креды из /etc/freepbx.conf (поддержка ' и ").
+    Сам SQL идёт в stdin mysql, а не в командную строку: без shell-экранирования
+    и без упора в длину аргумента на больших пачках INSERT.
     """
-    import shlex
     bash = r"""
 AMPDBUSER=$(awk -F"['\"]" '/AMPDBUSER/{print $4}' /etc/freepbx.conf)
 AMPDBPASS=$(awk -F"['\"]" '/AMPDBPASS/{print $4}' /etc/freepbx.conf)
@@ -163,46 +270,83 @@ if [ -z "$AMPDBUSER" ] || [ -z "$AMPDBPASS" ] || [ -z "$AMPDBNAME" ]; then
   echo "AMPDB vars not found" >&2
   exit 2
 fi
-mysql -N -B --user="$AMPDBUSER" --password="$AMPDBPASS" "$AMPDBNAME" -e %s
-""" % (shlex.quote(sql),)
-    return _ssh_run(host, username, password, bash, port=port, timeout=timeout)
+mysql -N -B --raw --user="$AMPDBUSER" --password="$AMPDBPASS" "$AMPDBNAME"
+"""
+    return _ssh_run(host, username, password, bash, port=port, timeout=timeout, stdin_data=sql + "\n")
+
+
+def _mysql_rows(out: str) -> List[List[str]]:
+    """Вывод mysql -N -B --raw -> строки результата, колонки разделены табом."""
+    return [ln.split("\t") for ln in out.splitlines() if ln]
+
+
+def _run_mysql_rows(host: str, username: str, password: str, sql: str,
+                    port: int = 22, timeout: int = 10) -> List[List[str]]:
+    """Как _ssh_run_mysql_single, но сразу разобранный на строки/колонки результат."""
+    return _mysql_rows(_ssh_run_mysql_single(host, username, password, sql, port=port, timeout=timeout))
+
+
+_SQL_SEP = "###SEP###"
+
+
+def _ssh_run_mysql_multi(host: str, username: str, password: str, sqls: List[str],
+                         port: int = 22, timeout: int = 10) -> List[str]:
+    """
+    Несколько SQL за один SSH exec и один запуск mysql.
+    Перед каждым запросом печатается разделитель, так что вывод режется
+    обратно по запросам: результат i-го SQL — i-й элемент списка.
+    """
+    script = "\n".join(f"SELECT '{_SQL_SEP}'; {q.strip().rstrip(';')};" for q in sqls)
+    out = _ssh_run_mysql_single(host, username, password, script, port=port, timeout=timeout)
+    blocks: List[List[str]] = []
+    for line in out.splitlines():
+        if line.strip() == _SQL_SEP:
+            blocks.append([])
+        elif blocks:
+            blocks[-1].append(line)
+    if len(blocks) < len(sqls):
+        # до части запросов mysql не дошёл — значит, предыдущий упал
+        raise SSHExecError(f"SQL прерван на запросе {len(blocks)} из {len(sqls)}")
+    return ["\n".join(b).strip() for b in blocks]
+
+
+def reload_freepbx(host: str, username: str, password: str, port: int = 22, timeout: int = 60) -> str:
+    """fwconsole reload — тяжёлый (несколько секунд), поэтому в пачках делаем его один раз в конце."""
+    return _ssh_run(host, username, password, "fwconsole reload", port=port, timeout=timeout)
 
 
 def set_incoming_trunk_sip_server_via_ssh(host: str, username: str, password: str,
                                           trunk_name: str = "goip32sell_incoming",
                                           new_ip: str = "1.2.3.4",
-                                          port: int = 22, timeout: int = 10) -> dict:
+                                          port: int = 22, timeout: int = 10,
+                                          do_reload: bool = True) -> dict:
     """
     1) Находим id транка по trunk_name/sv_trunk_name в таблице pjsip.
     2) Узнаём существующий формат значения sip_server.
     3) Обновляем sip_server значением new_ip (у вас — чистый IP).
-    4) Делаем fwconsole reload.
+    4) Делаем fwconsole reload (если do_reload).
     Возвращает краткий отчёт.
     """
-    # 1) Найти id по trunk_name (если нет — по sv_trunk_name)
-    sql_find_id = (
-        "SELECT id FROM pjsip "
-        f"WHERE (keyword='trunk_name' OR keyword='sv_trunk_name') AND data='{trunk_name}' "
-        "ORDER BY (keyword='trunk_name') DESC LIMIT 1;"
-    )
-    out = _ssh_run_mysql_single(host, username, password, sql_find_id, port=port, timeout=timeout).strip()
-    if not out:
+    # 1-3 одним вызовом mysql: id транка (по trunk_name, иначе sv_trunk_name),
+    # старое значение sip_server, обновление (в вашей схеме это просто IP) и проверка
+    sql_cur = "SELECT data FROM pjsip WHERE id=@tid AND keyword='sip_server' LIMIT 1"
+    found_id, cur_val, _, new_val = _ssh_run_mysql_multi(host, username, password, [
+        "SET @tid := (SELECT id FROM pjsip "
+        f"WHERE (keyword='trunk_name' OR keyword='sv_trunk_name') AND data='{_sql_escape(trunk_name)}' "
+        "ORDER BY (keyword='trunk_name') DESC LIMIT 1); SELECT @tid",
+        sql_cur,
+        f"UPDATE pjsip SET data='{_sql_escape(new_ip)}' WHERE id=@tid AND keyword='sip_server'",
+        sql_cur,
+    ], port=port, timeout=timeout)
+    rows = _mysql_rows(found_id)
+    trunk_id = rows[0][0].strip() if rows else ""
+    if not trunk_id or trunk_id == "NULL":
         raise SSHExecError(f"Не найден id для транка '{trunk_name}' в pjsip.")
-    trunk_id = out.splitlines()[0].strip()
-
-    # 2) Текущая строка sip_server (чтобы показать старое значение/проверить формат)
-    sql_cur = f"SELECT data FROM pjsip WHERE id={trunk_id} AND keyword='sip_server' LIMIT 1;"
-    cur_val = _ssh_run_mysql_single(host, username, password, sql_cur, port=port, timeout=timeout).strip()
-
-    # 3) Обновить (в вашей схеме sip_server — это просто IP)
-    sql_upd = f"UPDATE pjsip SET data='{new_ip}' WHERE id={trunk_id} AND keyword='sip_server';"
-    _ssh_run_mysql_single(host, username, password, sql_upd, port=port, timeout=timeout)
 
     # 4) Применить конфиг
-    _ssh_run(host, username, password, "fwconsole reload", port=port, timeout=timeout)
+    if do_reload:
+        reload_freepbx(host, username, password, port=port, timeout=max(timeout, 30))
 
-    # 5) Проверка/возврат нового значения
-    new_val = _ssh_run_mysql_single(host, username, password, sql_cur, port=port, timeout=timeout).strip()
     return {
         "trunk_id": trunk_id,
         "trunk_name": trunk_name,
@@ -214,6 +358,9 @@ def set_incoming_trunk_sip_server_via_ssh(host: str, username: str, password: st
 def _sql_escape(val: str) -> str:
     return val.replace("\\", "\\\\").replace("'", "\\'")
 
+
+_SECRET_RE = re.compile(r"[A-Za-z0-9._\-@]+")
+
 def set_extension_chansip_secret_via_ssh(
     host: str,
     username: str,
@@ -235,31 +382,25 @@ def set_extension_chansip_secret_via_ssh(
     if port:
         p = port
 
-    if not re.fullmatch(r"[A-Za-z0-9._\-@]+", new_secret):
+    if not _SECRET_RE.fullmatch(new_secret):
         raise SSHExecError("Недопустимый формат пароля (разрешены буквы/цифры/._-@)")
     esc = _sql_escape(new_secret)
     ext = str(int(extension))
 
-    # старое значение (для отчёта)
-    sql_read = f"SELECT data FROM sip WHERE id='{ext}' AND keyword='secret' LIMIT 1;"
-    cur = _ssh_run_mysql_single(h, username, password, sql_read, port=p, timeout=timeout).strip()
-    old_value = cur.splitlines()[0].strip() if cur else ""
-
-    # md5_cred присутствует?
-    sql_md5 = f"SELECT data FROM sip WHERE id='{ext}' AND keyword='md5_cred' LIMIT 1;"
-    md5 = _ssh_run_mysql_single(h, username, password, sql_md5, port=p, timeout=timeout).strip()
-    md5_present = bool(md5.splitlines()[0].strip()) if md5 else False
-
-    # пишем/обновляем secret
-    sql_write = (
+    # один вызов mysql: старое значение (для отчёта), есть ли md5_cred, запись secret
+    cur, md5, _ = _ssh_run_mysql_multi(h, username, password, [
+        f"SELECT data FROM sip WHERE id='{ext}' AND keyword='secret' LIMIT 1",
+        f"SELECT data FROM sip WHERE id='{ext}' AND keyword='md5_cred' LIMIT 1",
         f"INSERT INTO sip (id,keyword,data) VALUES ('{ext}','secret','{esc}') "
-        "ON DUPLICATE KEY UPDATE data=VALUES(data);"
-    )
-    _ssh_run_mysql_single(h, username, password, sql_write, port=p, timeout=timeout)
+        "ON DUPLICATE KEY UPDATE data=VALUES(data)",
+    ], port=p, timeout=timeout)
+    cur_rows, md5_rows = _mysql_rows(cur), _mysql_rows(md5)
+    old_value = cur_rows[0][0].strip() if cur_rows else ""
+    md5_present = bool(md5_rows[0][0].strip()) if md5_rows else False
 
     # применяем конфиг (по желанию)
     if do_reload:
-        _ssh_run(h, username, password, "fwconsole reload", port=p, timeout=max(timeout, 30))
+        reload_freepbx(h, username, password, port=p, timeout=max(timeout, 30))
 
     return {
         "ext": ext,
@@ -269,10 +410,80 @@ def set_extension_chansip_secret_via_ssh(
         "md5_present": md5_present,
     }
     
+def set_extension_chansip_secrets_bulk_via_ssh(
+    host: str,
+    username: str,
+    password: str,
+    pairs: List[Tuple[str, str]],
+    *,
+    port: int = 22,
+    timeout: int = 30,
+    do_reload: bool = True,
+) -> List[dict]:
+    """
+    Пакетная версия set_extension_chansip_secret_via_ssh: [(ext, new_secret), ...].
+    Один вызов mysql: выборка старых secret/md5_cred и многострочный
+    INSERT ... ON DUPLICATE KEY UPDATE (пачками по 500) в одной транзакции.
+    Возвращает отчёты в том же формате, что и одиночная версия.
+    """
+    h, p = _normalize_ssh_host(host)
+    if port:
+        p = port
+
+    rows: List[Tuple[str, str]] = []
+    for extension, secret in pairs:
+        if not _SECRET_RE.fullmatch(secret):
+            raise SSHExecError(f"Недопустимый формат пароля для {extension} (разрешены буквы/цифры/._-@)")
+        rows.append((str(int(extension)), secret))
+    if not rows:
+        return []
+
+    ids = ",".join(f"'{ext}'" for ext, _ in rows)
+    sqls = [
+        f"SELECT id, keyword, data FROM sip WHERE keyword IN ('secret','md5_cred') AND id IN ({ids})",
+        "START TRANSACTION",
+    ]
+    CHUNK = 500
+    for i in range(0, len(rows), CHUNK):
+        values = ",".join(f"('{ext}','secret','{_sql_escape(secret)}')" for ext, secret in rows[i:i + CHUNK])
+        sqls.append(f"INSERT INTO sip (id,keyword,data) VALUES {values} ON DUPLICATE KEY UPDATE data=VALUES(data)")
+    sqls.append("COMMIT")
+
+    try:
+        cur = _ssh_run_mysql_multi(h, username, password, sqls, port=p, timeout=timeout)[0]
+    except SSHExecError as e:
+        # до COMMIT не дошли — транзакция откатывается целиком: не записан ни один пароль,
+        # поэтому и отчёт, и reload не делаем
+        raise SSHExecError(f"Пароли не изменены (транзакция не завершена): {e}") from e
+    old: Dict[str, str] = {}
+    md5: set = set()
+    for row in _mysql_rows(cur):
+        if len(row) < 3:
+            continue
+        ext, keyword, data = row[:3]
+        if keyword == "secret":
+            old[ext] = data.strip()
+        elif keyword == "md5_cred" and data.strip():
+            md5.add(ext)
+
+    if do_reload:
+        reload_freepbx(h, username, password, port=p, timeout=max(timeout, 30))
+
+    return [
+        {
+            "ext": ext,
+            "old_value": old.get(ext) or "<empty>",
+            "new_value": secret,
+            "tech": "chan_sip",
+            "md5_present": ext in md5,
+        }
+        for ext, secret in rows
+    ]
+
 # ВНИЗ ФАЙЛА core/asterisk.py (рядом с set_incoming_trunk_sip_server_via_ssh и set_extension_chansip_secret_via_ssh)
-def _parse_range(s: str) -> list[str]:
+def _iter_range(s: str) -> Iterator[str]:
     """
-    '001-032' -> ['001','002',...,'032']
+    '001-032' -> '001','002',...,'032' (лениво, без списка)
     допускает также одиночное '007'
     """
     s = s.strip()
@@ -283,9 +494,19 @@ def _parse_range(s: str) -> list[str]:
         ia, ib = int(a), int(b)
         if ia > ib:
             ia, ib = ib, ia
-        return [str(i).zfill(w) for i in range(ia, ib + 1)]
+        for i in range(ia, ib + 1):
+            yield str(i).zfill(w)
     else:
-        return [s]
+        yield s
+
+
+def _range_len(s: str) -> int:
+    """Сколько значений даст _iter_range(s) — без генерации самих строк."""
+    s = s.strip()
+    if "-" in s:
+        a, b = s.split("-", 1)
+        return abs(int(b) - int(a)) + 1
+    return 1
 
 
 def create_outbound_route_with_ranges_via_ssh(
@@ -305,21 +526,20 @@ def create_outbound_route_with_ranges_via_ssh(
     # Прочее
     port: int = 22,
     timeout: int = 15,
+    do_reload: bool = True,
 ) -> dict:
     """
     Создаёт outbound route и добавляет два набора dial patterns:
       1) prepend='NNN+'  pattern=pattern_first,  callerid=NNN
       2) prepend='NNN'   pattern=pattern_second, callerid=NNN
     prefix='' (пусто). Транки (если заданы) привязываются по имени в порядке.
-    Делает fwconsole reload в конце.
+    Делает fwconsole reload в конце (если do_reload).
     """
     h, p = _normalize_ssh_host(host)
     if port:
         p = port
 
-    nums = _parse_range(prepend_range)
-    cids = _parse_range(callerid_range) if callerid_range else nums
-    if len(cids) != len(nums):
+    if callerid_range and _range_len(callerid_range) != _range_len(prepend_range):
         raise SSHExecError("Длины диапазонов prepend_range и callerid_range не совпадают.")
 
     # --- ШАГ 1. Получить/создать route_id (устраняем проблемы сравнения по collation) ---
@@ -348,64 +568,85 @@ WHERE NOT EXISTS (SELECT 1 FROM outbound_route_sequence WHERE route_id=@rid);
 SELECT @rid AS route_id, @rname AS route_name;
 """.strip()
 
-    res = _ssh_run_mysql_single(h, username, password, sql_get_or_create, port=p, timeout=timeout).strip()
-
-    # вытащим route_id
-    route_id = None
-    for line in res.splitlines():
-        parts = [x.strip() for x in line.split("\t")]
-        if len(parts) >= 2 and parts[0].isdigit():
-            route_id = int(parts[0])
-            break
-    if route_id is None:
-        raise SSHExecError("Не удалось получить route_id после вставки outbound_routes.")
+    # Шаги 1-3 уходят одним вызовом mysql: route_id живёт в @rid на стороне сервера,
+    # так что не нужен ни отдельный round-trip за ним, ни новый mysql на каждую пачку.
+    sqls = [sql_get_or_create]
 
-    # --- ШАГ 2. Вставить dial patterns уже с подставленным числовым route_id ---
+    # --- ШАГ 2. Dial patterns с route_id = @rid ---
     # таблица: (route_id, match_pattern_prefix, match_pattern_pass, match_cid, prepend_digits)
-    values = []
     esc_p1 = _sql_escape(pattern_first)
     esc_p2 = _sql_escape(pattern_second)
-    for n, cid in zip(nums, cids):
-        esc_cid = _sql_escape(cid)
-        esc_n   = _sql_escape(n)
-        # пачка 1: с плюсиком
-        values.append(f"({route_id},'', '{esc_p1}', '{esc_cid}', '{esc_n}+' )")
-        # пачка 2: без плюсика
-        values.append(f"({route_id},'', '{esc_p2}', '{esc_cid}', '{esc_n}'  )")
+
+    def _values():
+        nums = _iter_range(prepend_range)
+        cids = _iter_range(callerid_range or prepend_range)
+        for n, cid in zip(nums, cids):
+            esc_cid = _sql_escape(cid)
+            esc_n   = _sql_escape(n)
+            # пачка 1: с плюсиком
+            yield f"(@rid,'', '{esc_p1}', '{esc_cid}', '{esc_n}+' )"
+            # пачка 2: без плюсика
+            yield f"(@rid,'', '{esc_p2}', '{esc_cid}', '{esc_n}'  )"
 
     # В ряде сборок на эту таблицу навешан составной PK (все 5 полей) — подстрахуемся INSERT IGNORE.
     # Разобьём на чанк-и, чтобы не переполнить максимальную длину пакета (хотя 64 записи и так ок).
+    # Строки VALUES генерируются по ходу: в памяти не больше одного чанка.
+    # После каждой пачки — ROW_COUNT(): сколько строк реально вставлено (дубли INSERT IGNORE не в счёт).
     CHUNK = 200
-    for i in range(0, len(values), CHUNK):
-        chunk_sql = ",\n  ".join(values[i:i+CHUNK])
-        sql_ins = (
+    values = _values()
+    n_chunks = 0
+    while True:
+        chunk = list(islice(values, CHUNK))
+        if not chunk:
+            break
+        n_chunks += 1
+        chunk_sql = ",\n  ".join(chunk)
+        sqls.append(
             "INSERT IGNORE INTO outbound_route_patterns "
             "(route_id, match_pattern_prefix, match_pattern_pass, match_cid, prepend_digits) VALUES\n  "
-            + chunk_sql + ";"
+            + chunk_sql
+            + ";\nSELECT ROW_COUNT()"
         )
-        _ssh_run_mysql_single(h, username, password, sql_ins, port=p, timeout=timeout)
 
     # --- ШАГ 3. Привязать транки, если заданы ---
     if trunk_names:
         trunk_names_esc = [f"'{_sql_escape(t)}'" for t in trunk_names]
-        trunks_sql = f"""
+        sqls.append(f"""
 DROP TEMPORARY TABLE IF EXISTS tmp_trunks;
 CREATE TEMPORARY TABLE tmp_trunks AS
 SELECT trunkid, name FROM trunks WHERE name IN ({", ".join(trunk_names_esc)});
 
 INSERT INTO outbound_route_trunks (route_id, trunk_id, seq)
-SELECT {route_id}, t.trunkid, FIELD(t.name, {", ".join(trunk_names_esc)}) - 1
+SELECT @rid, t.trunkid, FIELD(t.name, {", ".join(trunk_names_esc)}) - 1
 FROM tmp_trunks t
 ORDER BY FIELD(t.name, {", ".join(trunk_names_esc)});
-""".strip()
-        _ssh_run_mysql_single(h, username, password, trunks_sql, port=p, timeout=timeout)
+""".strip())
+
+    # упавший запрос (ошибка mysql в stderr / ненулевой код) поднимает SSHExecError
+    blocks = _ssh_run_mysql_multi(h, username, password, sqls, port=p, timeout=timeout)
+    res = blocks[0]
+    patterns = 0
+    for block in blocks[1:1 + n_chunks]:
+        rows = _mysql_rows(block)
+        if rows and rows[-1][0].strip().lstrip("-").isdigit():
+            patterns += max(0, int(rows[-1][0]))
+
+    # вытащим route_id
+    route_id = None
+    for row in _mysql_rows(res):
+        if len(row) >= 2 and row[0].strip().isdigit():
+            route_id = int(row[0])
+            break
+    if route_id is None:
+        raise SSHExecError("Не удалось получить route_id после вставки outbound_routes.")
 
     # --- ШАГ 4. Применить конфиг ---
-    _ssh_run(h, username, password, "fwconsole reload", port=p, timeout=max(timeout, 30))
+    if do_reload:
+        reload_freepbx(h, username, password, port=p, timeout=max(timeout, 30))
 
     return {
         "route_id": str(route_id),
         "route_name": route_name,
-        "patterns_created": len(values),
+        "patterns_created": patterns,
         "trunks_bound": trunk_names or [],
     }
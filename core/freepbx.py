@@ -1,141 +1,566 @@
+import asyncio
 import logging
 import re
 import time
 
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 
-import requests
+import httpx
+import orjson
 
 log = logging.getLogger(__name__)
 
+# Сколько мутаций (алиасов) кладём в один GraphQL-документ
+GQL_BATCH_SIZE = 50
+
+# Сколько секунд ответы на query-запросы считаются свежими
+GQL_CACHE_TTL = 15.0
+# Пауза перед Apply Config: серия мутаций подряд даёт один reload
+APPLY_DEBOUNCE = 3.0
+# Токен обновляем заранее, если жить ему осталось меньше этого запаса (сек)
+TOKEN_SKEW = 60
+
+# Формы deleteExtension, встречающиеся в разных версиях API: (тип, поле, режим)
+_DELETE_VARIANTS = [
+    ("ID",     "id",           "input"),
+    ("String", "id",           "input"),
+    ("ID",     "extensionId",  "input"),
+    ("String", "extensionId",  "input"),
+    ("ID",     "extension",    "input"),
+    ("String", "extension",    "input"),
+    ("ID",     "extId",        "input"),
+    ("String", "extId",        "input"),
+    ("ID",     "id",           "direct"),
+    ("String", "id",           "direct"),
+    ("ID",     "extensionId",  "direct"),
+    ("String", "extensionId",  "direct"),
+    ("ID",     "extension",    "direct"),
+    ("String", "extension",    "direct"),
+    ("ID",     "extId",        "direct"),
+    ("String", "extId",        "direct"),
+]
+
+_NON_DIGIT_RE = re.compile(r"\D")
+
+# Сообщения валидации GraphQL (graphql-php и др.): запрос не подходит к схеме этого FreePBX.
+# Всё прочее (авторизация, ошибки резолверов) — настоящий сбой, а не «не та форма запроса».
+_SCHEMA_ERROR_RE = re.compile(
+    r"Cannot query field|Unknown argument|Unknown type|is not defined by type"
+    r"|Field \"[^\"]*\" argument|Variable \"\$|Expected type|must have a (?:sub-?)?selection"
+    r"|has invalid value|Syntax Error",
+    re.I,
+)
+_SCHEMA_ERROR_CODES = ("GRAPHQL_VALIDATION_FAILED", "GRAPHQL_PARSE_FAILED")
+
+_DELETE_ID_FIELDS = ("id", "extensionId", "extension", "extId")
+
+_Q_DELETE_ARGS = """
+query {
+  __schema {
+    mutationType {
+      fields { name args { name type { name kind ofType { name kind ofType { name kind } } } } }
+    }
+  }
+}
+"""
+_Q_INPUT_FIELDS = """
+query($name: String!) {
+  __type(name: $name) {
+    inputFields { name type { name kind ofType { name kind ofType { name kind } } } }
+  }
+}
+"""
+
+
+# Наборы полей fetchAllExtensions для схем без интроспекции: от полного к минимальному
+_EXT_SELECTIONS = [
+    "extensionId tech pjsip { secret } user { password extPassword name displayname }",
+    "extensionId tech pjsip { secret } user { password extPassword }",
+    "extensionId user { extPassword name displayname }",
+    "extensionId user { password extPassword }",
+    "extensionId user { password }",
+    "extensionId",
+]
+
+
+def _ext_selection_query(fields: str) -> str:
+    return "query { fetchAllExtensions { extension { " + fields + " } } }"
+
+
+def _named_type(t: Optional[dict]) -> Optional[str]:
+    """Имя типа за обёртками NON_NULL/LIST."""
+    while t:
+        if t.get("name"):
+            return t["name"]
+        t = t.get("ofType")
+    return None
+
+
+_Q_QUERY_FIELDS = """
+query {
+__schema {
+    queryType {
+    fields { name }
+    }
+}
+}
+"""
+_Q_MUTATIONS = """
+query {
+__schema {
+    mutationType {
+    fields { name }
+    }
+}
+}
+"""
+
+
+def _ext_sort_key(pair: Tuple[str, str], _strip=_NON_DIGIT_RE.sub) -> int:
+    ext = pair[0]
+    if ext.isascii() and ext.isdigit():  # обычный случай — без regex
+        return int(ext)
+    return int(_strip("", ext) or 0)
+
 
 class AlreadyExists(Exception):
     """Raised when an entity already exists on FreePBX side."""
     pass
 
 
+class FreePBXAuthError(RuntimeError):
+    """Token endpoint or GraphQL rejected the credentials (HTTP 400/401/403)."""
+    pass
+
+
+class FreePBXSchemaError(RuntimeError):
+    """Query did not pass schema validation: the field/argument is not supported by this FreePBX."""
+    pass
+
+
+_AUTH_STATUSES = (400, 401, 403)
+
+# Сбои транспорта и авторизации: перебор форм запроса (variant loops) их не глотает —
+# другая форма тут не поможет, а «all variants failed» только прячет настоящую причину
+_TRANSPORT_ERRORS = (httpx.HTTPError, FreePBXAuthError)
+# Временные ответы сервера: query можно повторить (с паузой), мутацию — нет
+_RETRY_STATUSES = (429, 502, 503, 504)
+_RETRY_DELAYS = (0.4, 0.8, 1.6)
+
+# Общие на процесс HTTP-клиенты (ключ — verify): пул соединений живёт всё время работы бота,
+# поэтому TLS-рукопожатие с хостом FreePBX происходит один раз, а не на каждый /connect.
+_SHARED_CLIENTS: Dict[bool, httpx.AsyncClient] = {}
+
+
+def _shared_client(verify: bool) -> httpx.AsyncClient:
+    c = _SHARED_CLIENTS.get(verify)
+    if c is None or c.is_closed:
+        # retries — только повтор неудачного соединения (обрыв/таймаут connect), не запросов
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            verify=verify,
+            retries=3,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+        # HTTP/2: параллельные запросы к одному хосту идут потоками в одном соединении
+        c = httpx.AsyncClient(
+            transport=transport,
+            headers={"User-Agent": "freepbx-bot/1.0"},
+            timeout=httpx.Timeout(35.0, connect=10.0),
+        )
+        _SHARED_CLIENTS[verify] = c
+    return c
+
+
+async def aclose_shared_clients() -> None:
+    """Закрыть общие HTTP-клиенты (при остановке бота)."""
+    clients = list(_SHARED_CLIENTS.values())
+    _SHARED_CLIENTS.clear()
+    for c in clients:
+        if not c.is_closed:
+            await c.aclose()
+
+
 class FreePBX:
     def __init__(self, base_url: str, client_id: str, client_secret: str, verify: bool = True):
         self.base_url = base_url.rstrip("/")
+        # URL-ы неизменны после создания — собираем один раз
+        self.token_url = f"{self.base_url}/admin/api/api/token"
+        self.gql_url = f"{self.base_url}/admin/api/api/gql"
+        self.ajax_url = f"{self.base_url}/admin/ajax.php"
         self.client_id = client_id
         self.client_secret = client_secret
         self.verify = verify
         self.token: Optional[str] = None
         self.token_exp: float = 0.0
+        # Вызывается с (token, token_exp) после получения нового токена — чтобы его можно было
+        # сохранить вместе с сессией и не запрашивать заново после рестарта
+        self.on_token: Optional[Callable[[str, float], None]] = None
+        self._client: Optional[httpx.AsyncClient] = None
+        self._token_lock = asyncio.Lock()
+        # Рабочие формы мутаций, найденные перебором: "delete", "update_type", "inbound_dest".
+        # Словарь можно подменить общим из сессии, чтобы находка пережила переподключение.
+        self.hints: Dict[str, object] = {}
+        # Вызывается после любого изменения hints — чтобы сохранить их вместе с сессией
+        self.on_hints: Optional[Callable[[], None]] = None
+        # Поля fetchAllExtensions по данным интроспекции: {"": {...}, "user": {...}, "pjsip": {...}}
+        self.extension_fields: Optional[Dict[str, set]] = None
+        # Порядок форм deleteExtension по интроспекции — пока рабочая форма не запомнена в hints
+        self._delete_order: Optional[list] = None
+        # Кэш ответов на query: ключ -> (monotonic-время, data). Чистится любой мутацией.
+        self._cache: Dict[str, Tuple[float, dict]] = {}
+        # {DID: маршрут} поверх _try_fetch_inbound_routes — живёт вместе с кэшем gql
+        self._inbound_index: Optional[Tuple[float, Dict[str, dict]]] = None
+        # Отложенный Apply Config: задача и ожидающие её результата
+        self._apply_pending: Optional[asyncio.Task] = None  # ещё ждёт окончания паузы
+        self._apply_tasks: set = set()
+        self._apply_lock = asyncio.Lock()
+        self._apply_waiters: List[asyncio.Future] = []
 
-    # ----- URLs -----
+    # ----- HTTP client -----
     @property
-    def token_url(self) -> str:
-        return f"{self.base_url}/admin/api/api/token"
+    def client(self) -> httpx.AsyncClient:
+        """
+        Общий на процесс AsyncClient (HTTP/2 + keep-alive), чтобы не платить
+        за TCP/TLS-рукопожатие на каждый GraphQL-вызов. Токен у каждого экземпляра свой
+        и передаётся заголовком запроса.
+        """
+        if self._client is None or self._client.is_closed:
+            self._client = _shared_client(self.verify)
+        return self._client
 
-    @property
-    def gql_url(self) -> str:
-        return f"{self.base_url}/admin/api/api/gql"
+    async def aclose(self) -> None:
+        # Общий пул не закрываем — он нужен другим сессиям; см. aclose_shared_clients()
+        self._client = None
 
     # ----- Auth / GQL -----
-    def ensure_token(self) -> None:
-        now = time.time()
-        if self.token and now < self.token_exp - 30:
-            return
-        data = {
-            "grant_type": "client_credentials",
-            "client_id": self.client_id,
-            "client_secret": self.client_secret,
-            "scope": "gql gql:core",
-        }
-        r = requests.post(self.token_url, data=data, timeout=25, verify=self.verify)
-        r.raise_for_status()
-        j = r.json()
-        self.token = j["access_token"]
-        self.token_exp = now + int(j.get("expires_in", 3600))
-
-    def gql(self, query: str, variables: Optional[dict] = None) -> dict:
-        self.ensure_token()
-        h = {"Authorization": f"Bearer {self.token}"}
-        r = requests.post(
-            self.gql_url,
-            json={"query": query, "variables": variables or {}},
-            timeout=35,
-            verify=self.verify,
-            headers=h,
-        )
+    async def ensure_token(self) -> None:
+        async with self._token_lock:
+            now = time.time()
+            if self.token and now < self.token_exp - TOKEN_SKEW:
+                return
+            data = {
+                "grant_type": "client_credentials",
+                "client_id": self.client_id,
+                "client_secret": self.client_secret,
+                "scope": "gql gql:core",
+            }
+            r = await self.client.post(self.token_url, data=data, timeout=25)
+            if r.status_code in _AUTH_STATUSES:
+                raise FreePBXAuthError(f"token: HTTP {r.status_code}: {r.text[:200]}")
+            r.raise_for_status()
+            j = r.json()
+            self.token = j["access_token"]
+            self.token_exp = now + int(j.get("expires_in", 3600))
+            if self.on_token is not None:
+                try:
+                    self.on_token(self.token, self.token_exp)
+                except Exception as e:
+                    log.warning(f"on_token hook failed: {e}")
+
+    @staticmethod
+    def _is_mutation(query: str) -> bool:
+        return query.lstrip().startswith("mutation")
+
+    def invalidate_cache(self) -> None:
+        self._cache.clear()
+        self._inbound_index = None
+
+    async def _post(self, body: bytes, retry: bool = False) -> httpx.Response:
+        """
+        POST готового JSON на gql_url с токеном; при 401/403 один раз обновляет токен.
+        retry=True (только для query) — повтор с нарастающей паузой на 429/502/503/504.
+        """
+        for delay in _RETRY_DELAYS if retry else ():
+            r = await self._post_authed(body)
+            if r.status_code not in _RETRY_STATUSES:
+                return r
+            log.debug(f"GraphQL: HTTP {r.status_code}, retry in {delay}s")
+            await asyncio.sleep(delay)
+        return await self._post_authed(body)
+
+    async def _post_authed(self, body: bytes) -> httpx.Response:
+        for attempt in (1, 2):
+            await self.ensure_token()
+            token = self.token
+            h = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+            r = await self.client.post(self.gql_url, content=body, headers=h)
+            if r.status_code not in (401, 403):
+                break
+            # токен отозван/протух раньше срока — один раз берём новый и повторяем
+            if self.token == token:
+                self.token = None
+            if attempt == 2:
+                raise FreePBXAuthError(f"GraphQL: HTTP {r.status_code}")
+        return r
+
+    async def _gql_raw(self, query: str, variables: Optional[dict] = None) -> dict:
+        if self._is_mutation(query):
+            self.invalidate_cache()
+        r = await self._post(orjson.dumps({"query": query, "variables": variables or {}}),
+                             retry=not self._is_mutation(query))
+        if r.status_code == 400:
+            # GraphQL-over-HTTP: ошибки валидации могут прийти с кодом 400 — это «не та форма», не сбой
+            try:
+                js = orjson.loads(r.content)
+            except orjson.JSONDecodeError:
+                js = None
+            if isinstance(js, dict) and js.get("errors"):
+                return js
         r.raise_for_status()
-        js = r.json()
+        return orjson.loads(r.content)
+
+    @staticmethod
+    def _is_schema_error(e) -> bool:
+        if not isinstance(e, dict) or e.get("path"):
+            return False  # с path — ошибка выполнения конкретного поля
+        ext = e.get("extensions") or {}
+        if ext.get("code") in _SCHEMA_ERROR_CODES or ext.get("category") == "graphql":
+            return True
+        return bool(_SCHEMA_ERROR_RE.search(str(e.get("message", ""))))
+
+    @classmethod
+    def _raise_errors(cls, errors: list) -> None:
+        # FreePBXSchemaError — только если все ошибки валидационные: перебор форм запроса
+        # идёт дальше лишь на них, остальное должно дойти до пользователя как есть
+        if errors and all(cls._is_schema_error(e) for e in errors):
+            raise FreePBXSchemaError(errors)
+        raise RuntimeError(errors)
+
+    async def gql(self, query: str, variables: Optional[dict] = None, use_cache: bool = True) -> dict:
+        key = None
+        if use_cache and not self._is_mutation(query):
+            key = self._cache_key(query, variables)
+            hit = self._cache.get(key)
+            if hit and time.monotonic() - hit[0] < GQL_CACHE_TTL:
+                return hit[1]
+        js = await self._gql_raw(query, variables)
         if "errors" in js:
-            raise RuntimeError(js["errors"])
+            self._raise_errors(js["errors"])
+        if key is not None:
+            self._cache[key] = (time.monotonic(), js["data"])
         return js["data"]
 
-    # ----- Extensions: read -----
-    def fetch_all_extensions(self) -> List[Tuple[str, str]]:
-        q_full = """
+    @staticmethod
+    def _cache_key(query: str, variables: Optional[dict]) -> str:
+        return query + "\0" + orjson.dumps(variables or {}, option=orjson.OPT_SORT_KEYS).decode()
+
+    async def gql_many(self, ops: List[Tuple[str, Optional[dict]]]) -> list:
+        """
+        Несколько независимых операций одним POST — JSON-массивом [{query, variables}, …].
+        Возвращает список той же длины: data операции или исключение (как бросил бы gql).
+        Свежие ответы на query берутся из кэша. Если сервер массивы не принимает (400 или
+        ответ не массивом), это запоминается в hints["array_batch"], и операции идут по одной.
+        """
+        out: list = [None] * len(ops)
+        todo: List[int] = []
+        for i, (q, v) in enumerate(ops):
+            hit = None if self._is_mutation(q) else self._cache.get(self._cache_key(q, v))
+            if hit and time.monotonic() - hit[0] < GQL_CACHE_TTL:
+                out[i] = hit[1]
+            else:
+                todo.append(i)
+        if not todo:
+            return out
+
+        items = None
+        if self.hints.get("array_batch") is not False and len(todo) > 1:
+            has_mutation = any(self._is_mutation(ops[i][0]) for i in todo)
+            if has_mutation:
+                self.invalidate_cache()
+            r = await self._post(orjson.dumps([{"query": ops[i][0], "variables": ops[i][1] or {}} for i in todo]),
+                                 retry=not has_mutation)
+            if r.status_code >= 500:
+                r.raise_for_status()
+            try:
+                body = orjson.loads(r.content)
+            except orjson.JSONDecodeError:
+                body = None
+            if isinstance(body, list) and len(body) == len(todo):
+                items = body
+                self._set_hint("array_batch", True)
+            elif r.is_success or r.status_code == 400:
+                # сервер ответил, но массив не понял — это окончательно
+                self._set_hint("array_batch", False)
+            # 429 и прочие временные ответы ничего не решают: сейчас — по одной, в следующий раз — снова массивом
+
+        if items is None:
+            # массивы не поддерживаются (или операция одна) — обычные запросы, параллельно
+            res = await asyncio.gather(*(self.gql(*ops[i]) for i in todo), return_exceptions=True)
+            for i, x in zip(todo, res):
+                out[i] = x
+            return out
+
+        for i, js in zip(todo, items):
+            js = js if isinstance(js, dict) else {}
+            try:
+                if "errors" in js:
+                    self._raise_errors(js["errors"])
+                if "data" not in js:
+                    raise RuntimeError("GraphQL batch: пустой ответ")
+            except Exception as e:
+                out[i] = e
+                continue
+            out[i] = js["data"]
+            if not self._is_mutation(ops[i][0]):
+                self._cache[self._cache_key(*ops[i])] = (time.monotonic(), js["data"])
+        return out
+
+    async def _gql_batch(self, query: str, variables: dict, aliases: Dict[str, str]) -> Dict[str, Optional[str]]:
+        """
+        Выполняет документ с несколькими алиасами (alias -> ext).
+        Возвращает {ext: None | текст ошибки}. Если документ не принят целиком
+        (ошибка валидации схемы) — бросает исключение.
+        """
+        js = await self._gql_raw(query, variables)
+        data = js.get("data")
+        errors = js.get("errors") or []
+        if not data:
+            if errors:
+                self._raise_errors(errors)
+            raise RuntimeError("GraphQL batch: пустой ответ")
+
+        by_alias: Dict[str, str] = {}
+        for e in errors:
+            path = e.get("path") or []
+            if path:
+                by_alias.setdefault(str(path[0]), str(e.get("message", "")))
+        fallback = str(errors[0].get("message", "")) if errors else "нет ответа"
+
+        out: Dict[str, Optional[str]] = {}
+        for alias, ext in aliases.items():
+            if alias in by_alias:
+                out[ext] = by_alias[alias] or fallback
+            elif data.get(alias) is None:
+                out[ext] = fallback
+            else:
+                out[ext] = None
+        return out
+
+    def _hint(self, key: str):
+        known = self.hints.get(key)
+        return tuple(known) if isinstance(known, list) else known  # из JSON сессии приходят списки
+
+    def _set_hint(self, key: str, value) -> None:
+        if self._hint(key) == value:
+            return
+        self.hints[key] = value
+        self._hints_changed()
+
+    def _drop_hint(self, key: str, value=None) -> None:
+        """Забыть вариант (только если запомнен именно value, когда он задан)."""
+        if key not in self.hints or (value is not None and self._hint(key) != value):
+            return
+        del self.hints[key]
+        self._hints_changed()
+
+    def _hints_changed(self) -> None:
+        if self.on_hints is not None:
+            try:
+                self.on_hints()
+            except Exception as e:
+                log.warning(f"on_hints hook failed: {e}")
+
+    def _ordered(self, key: str, options: list) -> list:
+        """Уже найденный рабочий вариант — первым, остальные за ним: схема могла поменяться."""
+        known = self._hint(key)
+        if known in options:
+            return [known] + [o for o in options if o != known]
+        return list(options)
+
+    # ----- Schema -----
+    async def introspect(self) -> None:
+        """
+        Один раз читает схему и запоминает, какие поля есть у fetchAllExtensions,
+        чтобы дальше строить ровно один подходящий запрос без перебора.
+        """
+        q = """
         query {
-          fetchAllExtensions {
-            extension {
-              extensionId
-              tech
-              pjsip { secret }
-              user { password extPassword }
+          __schema {
+            queryType { name }
+            types {
+              name
+              fields { name type { name ofType { name ofType { name ofType { name } } } } }
             }
           }
         }
         """
-        q_fallback = """
-        query {
-          fetchAllExtensions {
-            extension {
-              extensionId
-              user { password extPassword }
-            }
-          }
+        data = await self.gql(q)
+
+        types: Dict[str, Dict[str, Optional[str]]] = {}
+        for t in data["__schema"]["types"]:
+            types[t["name"]] = {f["name"]: _named_type(f.get("type")) for f in (t.get("fields") or [])}
+
+        root = types.get(data["__schema"]["queryType"]["name"]) or {}
+        conn = types.get(root.get("fetchAllExtensions")) or {}
+        ext_t = types.get(conn.get("extension")) or {}
+        if "extensionId" not in ext_t:
+            self.extension_fields = None  # схема неожиданная — остаёмся на запросах с фоллбеком
+            return
+        self.extension_fields = {
+            "": set(ext_t),
+            "user": set(types.get(ext_t.get("user")) or {}),
+            "pjsip": set(types.get(ext_t.get("pjsip")) or {}),
         }
+
+    def _ext_query(self, top: tuple = ("tech",), user: tuple = ("password", "extPassword", "name", "displayname"),
+                   pjsip: tuple = ("secret",)) -> str:
         """
-        try:
-            data = self.gql(q_full)
-            exts = data["fetchAllExtensions"]["extension"]
-        except Exception:
-            data = self.gql(q_fallback)
-            exts = data["fetchAllExtensions"]["extension"]
+        Запрос fetchAllExtensions только с полями, которые есть в схеме.
+        По умолчанию — один общий набор полей для списка и индекса имён: тогда
+        fetch_all_extensions и fetch_ext_index попадают в один и тот же кэш gql.
+        """
+        f = self.extension_fields or {}
+        parts = ["extensionId"] + [x for x in top if x in f.get("", ())]
+        u = [x for x in user if x in f.get("user", ())]
+        if u and "user" in f.get("", ()):
+            parts.append("user { " + " ".join(u) + " }")
+        pj = [x for x in pjsip if x in f.get("pjsip", ())]
+        if pj and "pjsip" in f.get("", ()):
+            parts.append("pjsip { " + " ".join(pj) + " }")
+        return "query { fetchAllExtensions { extension { " + " ".join(parts) + " } } }"
+
+    # ----- Extensions: read -----
+    async def _fetch_extensions_full(self) -> list:
+        """
+        Все EXT одним fetchAllExtensions — с полями и для списка (пароли), и для индекса имён.
+        Если схема известна — ровно один запрос по ней; иначе цепочка _EXT_SELECTIONS
+        от полного набора полей к минимальному, подошедший вариант запоминается в hints.
+        Если не подошёл ни один — FreePBXSchemaError (а не пустой список).
+        Повторные вызовы в пределах GQL_CACHE_TTL берут ответ из кэша gql.
+        """
+        if self.extension_fields:
+            data = await self.gql(self._ext_query())
+            return data["fetchAllExtensions"]["extension"]
+
+        order = self._ordered("ext_query", list(range(len(_EXT_SELECTIONS))))
+        # сначала наиболее полный (или уже известный) вариант, остальные — одним пакетом;
+        # если известный перестал подходить, он забывается и перебирается вся цепочка
+        last_err: Optional[Exception] = None
+        for group in (order[:1], order[1:]):
+            results = await self.gql_many([(_ext_selection_query(_EXT_SELECTIONS[i]), None) for i in group])
+            for i, data in zip(group, results):
+                if isinstance(data, FreePBXSchemaError):
+                    self._drop_hint("ext_query", i)
+                    last_err = data
+                    continue
+                if isinstance(data, Exception):
+                    raise data
+                self._set_hint("ext_query", i)
+                return data["fetchAllExtensions"]["extension"]
+        raise FreePBXSchemaError(f"fetchAllExtensions: ни один вариант запроса не подошёл ({last_err})")
 
+    async def fetch_all_extensions(self) -> List[Tuple[str, str]]:
         out: List[Tuple[str, str]] = []
-        for e in exts:
+        for e in await self._fetch_extensions_full():
             ext = str(e["extensionId"])
             u = e.get("user") or {}
             pw = u.get("extPassword") or (e.get("pjsip", {}) or {}).get("secret") or u.get("password") or ""
             out.append((ext, pw))
-        out.sort(key=lambda x: int(re.sub(r"\D", "", x[0]) or 0))
+        out.sort(key=_ext_sort_key)
         return out
 
-    def fetch_ext_index(self):
-        queries = [
-            """
-            query {
-              fetchAllExtensions {
-                extension {
-                  extensionId
-                  user { extPassword name displayname }
-                }
-              }
-            }
-            """,
-            """
-            query {
-              fetchAllExtensions {
-                extension {
-                  extensionId
-                  user { password }
-                }
-              }
-            }
-            """,
-            """
-            query {
-              fetchAllExtensions {
-                extension { extensionId }
-              }
-            }
-            """,
-        ]
-
+    async def fetch_ext_index(self):
         def pick_name(e: dict) -> str:
             u = e.get("user") or {}
             for k in ("name", "displayname", "username"):
@@ -144,68 +569,112 @@ class FreePBX:
                     return v.strip()
             return ""
 
-        for q in queries:
-            try:
-                data = self.gql(q)
-                exts = data["fetchAllExtensions"]["extension"]
-                by_ext: Dict[str, Dict[str, str]] = {}
-                name_set = set()
-                for e in exts:
-                    ext = str(e["extensionId"])
-                    name = pick_name(e)
-                    by_ext[ext] = {"name": name, "pw": ""}
-                    if name:
-                        name_set.add(name.lower())
-                return by_ext, name_set, bool(name_set)
-            except Exception:
-                continue
-
-        return {}, set(), False
+        by_ext: Dict[str, Dict[str, str]] = {}
+        name_set = set()
+        for e in await self._fetch_extensions_full():
+            ext = str(e["extensionId"])
+            name = pick_name(e)
+            by_ext[ext] = {"name": name, "pw": ""}
+            if name:
+                name_set.add(name.lower())
+        return by_ext, name_set, bool(name_set)
 
     # ----- Extensions: write -----
-    def delete_extension(self, extension: str) -> None:
+    @staticmethod
+    def _delete_call(field: str, mode: str, var: str) -> str:
+        if mode == "input":
+            return f"deleteExtension(input: {{ {field}: ${var} }}) {{ status message }}"
+        return f"deleteExtension({field}: ${var}) {{ status message }}"
+
+    async def _introspect_delete(self) -> Optional[tuple]:
+        """
+        Форма deleteExtension по схеме: (тип, поле, режим) из _DELETE_VARIANTS
+        или None, если схема не читается / форма незнакомая.
+        """
+        try:
+            data = await self.gql(_Q_DELETE_ARGS)
+            fields = (data["__schema"]["mutationType"] or {}).get("fields") or []
+            args = next((f.get("args") or [] for f in fields if f["name"] == "deleteExtension"), [])
+            by_name = {a["name"]: a.get("type") for a in args}
+            mode = "direct"
+            if "input" in by_name and not any(n in by_name for n in _DELETE_ID_FIELDS):
+                mode = "input"
+                inp = await self.gql(_Q_INPUT_FIELDS, {"name": _named_type(by_name["input"])})
+                by_name = {f["name"]: f.get("type") for f in (inp.get("__type") or {}).get("inputFields") or []}
+        except Exception as e:
+            log.debug(f"deleteExtension introspection failed: {e}")
+            return None
+        for field in _DELETE_ID_FIELDS:
+            variant = (_named_type(by_name.get(field)), field, mode)
+            if variant in _DELETE_VARIANTS:
+                return variant
+        return None
+
+    async def _delete_variants(self) -> list:
+        """
+        Формы deleteExtension для перебора. Запомненная в hints — первой, без запросов;
+        без неё — найденная интроспекцией (схема читается один раз на экземпляр).
+        """
+        if self._hint("delete") is not None:
+            return self._ordered("delete", _DELETE_VARIANTS)
+        if self._delete_order is None:
+            found = await self._introspect_delete()
+            variants = list(_DELETE_VARIANTS)
+            self._delete_order = variants if found is None else [found] + [v for v in variants if v != found]
+        return self._delete_order
+
+    async def delete_extension(self, extension: str) -> None:
         ext_str = str(extension)
-        variants = [
-            ("ID",     "id",           "input"),
-            ("String", "id",           "input"),
-            ("ID",     "extensionId",  "input"),
-            ("String", "extensionId",  "input"),
-            ("ID",     "extension",    "input"),
-            ("String", "extension",    "input"),
-            ("ID",     "extId",        "input"),
-            ("String", "extId",        "input"),
-            ("ID",     "id",           "direct"),
-            ("String", "id",           "direct"),
-            ("ID",     "extensionId",  "direct"),
-            ("String", "extensionId",  "direct"),
-            ("ID",     "extension",    "direct"),
-            ("String", "extension",    "direct"),
-            ("ID",     "extId",        "direct"),
-            ("String", "extId",        "direct"),
-        ]
+        variants = await self._delete_variants()
         last_err = None
-        for typ, field, mode in variants:
-            if mode == "input":
-                m = f"""
-                mutation($ext: {typ}!) {{
-                  deleteExtension(input: {{ {field}: $ext }}) {{ status message }}
-                }}
-                """
-            else:
-                m = f"""
+        # сначала наиболее вероятная форма; остальные — одним пакетом, только если она не подошла
+        # (схеме соответствует одна форма, прочие отсекаются валидацией)
+        for group in (variants[:1], variants[1:]):
+            ops = [
+                (f"""
                 mutation($ext: {typ}!) {{
-                  deleteExtension({field}: $ext) {{ status message }}
+                  {self._delete_call(field, mode, "ext")}
                 }}
-                """
-            try:
-                self.gql(m, {"ext": ext_str})
+                """, {"ext": ext_str})
+                for typ, field, mode in group
+            ]
+            for variant, res in zip(group, await self.gql_many(ops)):
+                if isinstance(res, FreePBXSchemaError):
+                    self._drop_hint("delete", variant)
+                    last_err = res
+                    continue
+                if isinstance(res, Exception):
+                    raise res
+                self._set_hint("delete", variant)
                 return
-            except Exception as e:
+        raise RuntimeError(f"deleteExtension failed (all variants): {last_err}")
+
+    async def delete_many(self, extensions: List[str]) -> Dict[str, Optional[str]]:
+        """
+        Удаляет пачку EXT одним GraphQL-документом (алиасы d0, d1, …).
+        Возвращает {ext: None | текст ошибки}.
+        """
+        exts = [str(x) for x in extensions]
+        if not exts:
+            return {}
+        variables = {f"x{i}": ext for i, ext in enumerate(exts)}
+        aliases = {f"d{i}": ext for i, ext in enumerate(exts)}
+        last_err = None
+        for typ, field, mode in await self._delete_variants():
+            decls = ", ".join(f"$x{i}: {typ}!" for i in range(len(exts)))
+            body = "\n".join(f"  d{i}: {self._delete_call(field, mode, f'x{i}')}" for i in range(len(exts)))
+            m = f"mutation({decls}) {{\n{body}\n}}"
+            try:
+                res = await self._gql_batch(m, variables, aliases)
+            except FreePBXSchemaError as e:
+                self._drop_hint("delete", (typ, field, mode))
                 last_err = e
                 continue
-        raise RuntimeError(f"deleteExtension failed (all variants): {last_err}")
+            self._set_hint("delete", (typ, field, mode))
+            return res
+        raise RuntimeError(f"deleteExtension batch failed (all variants): {last_err}")
 
-    def create_one(self, ext: int, name: Optional[str] = None) -> None:
+    async def create_one(self, ext: int, name: Optional[str] = None) -> None:
         m = """
         mutation($start: ID!, $name: String!, $email: String!) {
           createRangeofExtension(input:{
@@ -228,9 +697,30 @@ class FreePBX:
             "name": nm,
             "email": f"{ext}@local",
         }
-        self.gql(m, vars)
+        await self.gql(m, vars)
+
+    async def create_many(self, specs: List[Tuple[int, Optional[str]]]) -> Dict[str, Optional[str]]:
+        """
+        Создаёт пачку EXT одним GraphQL-документом: specs = [(ext, name), …].
+        Возвращает {ext: None | текст ошибки}.
+        """
+        decls, fields, variables, aliases = [], [], {}, {}
+        for i, (ext, name) in enumerate(specs):
+            nm = str(name).strip() if (name and str(name).strip()) else str(ext)
+            decls.append(f"$s{i}: ID!, $n{i}: String!, $e{i}: String!")
+            fields.append(
+                f"  c{i}: createRangeofExtension(input:{{ startExtension: $s{i}, numberOfExtensions: 1, "
+                f"tech: \"pjsip\", name: $n{i}, email: $e{i}, vmEnable: true, umEnable: true }}) "
+                "{ status message }"
+            )
+            variables.update({f"s{i}": str(ext), f"n{i}": nm, f"e{i}": f"{ext}@local"})
+            aliases[f"c{i}"] = str(ext)
+        if not aliases:
+            return {}
+        m = f"mutation({', '.join(decls)}) {{\n" + "\n".join(fields) + "\n}"
+        return await self._gql_batch(m, variables, aliases)
 
-    def set_ext_password(self, extension: str, secret: str) -> None:
+    async def set_ext_password(self, extension: str, secret: str) -> None:
         m_id = """
         mutation($extId: ID!, $name: String!, $pwd: String!) {
           updateExtension(input: {
@@ -249,18 +739,59 @@ class FreePBX:
           }) { status message }
         }
         """
-        vars_id = {"extId": str(extension), "name": str(extension), "pwd": secret}
-        try:
-            self.gql(m_id, vars_id)
-        except Exception as e1:
-            vars_str = {"extId": str(extension), "name": str(extension), "pwd": secret}
+        mutations = {"ID": m_id, "String": m_str}
+        variables = {"extId": str(extension), "name": str(extension), "pwd": secret}
+        errs = []
+        types = self._ordered("update_type", ["ID", "String"])
+        # известный тип — отдельным запросом, остальные только если он перестал подходить;
+        # пока тип не известен — все варианты одним пакетом
+        groups = (types[:1], types[1:]) if self._hint("update_type") else (types,)
+        for group in groups:
+            results = await self.gql_many([(mutations[typ], variables) for typ in group])
+            for typ, res in zip(group, results):
+                if isinstance(res, FreePBXSchemaError):
+                    self._drop_hint("update_type", typ)
+                    errs.append(f"{typ}! -> {res}")
+                    continue
+                if isinstance(res, Exception):
+                    raise res
+                self._set_hint("update_type", typ)
+                return
+        raise RuntimeError("updateExtension failed: " + "; ".join(errs))
+
+    async def set_passwords_many(self, pairs: List[Tuple[str, str]]) -> Dict[str, Optional[str]]:
+        """
+        Задаёт extPassword пачке EXT одним GraphQL-документом: pairs = [(ext, secret), …].
+        Возвращает {ext: None | текст ошибки}.
+        """
+        pairs = [(str(ext), pwd) for ext, pwd in pairs]
+        if not pairs:
+            return {}
+        variables: Dict[str, str] = {}
+        for i, (ext, pwd) in enumerate(pairs):
+            variables.update({f"x{i}": ext, f"n{i}": ext, f"p{i}": pwd})
+        aliases = {f"u{i}": ext for i, (ext, _) in enumerate(pairs)}
+        fields = "\n".join(
+            f"  u{i}: updateExtension(input: {{ extensionId: $x{i}, name: $n{i}, extPassword: $p{i} }}) "
+            "{ status message }"
+            for i in range(len(pairs))
+        )
+        errs = []
+        for typ in self._ordered("update_type", ["ID", "String"]):
+            decls = ", ".join(f"$x{i}: {typ}!, $n{i}: String!, $p{i}: String!" for i in range(len(pairs)))
+            m = f"mutation({decls}) {{\n{fields}\n}}"
             try:
-                self.gql(m_str, vars_str)
-            except Exception as e2:
-                raise RuntimeError(f"updateExtension failed: ID! -> {e1}; String! -> {e2}")
+                res = await self._gql_batch(m, variables, aliases)
+            except FreePBXSchemaError as e:
+                self._drop_hint("update_type", typ)
+                errs.append(f"{typ}! -> {e}")
+                continue
+            self._set_hint("update_type", typ)
+            return res
+        raise RuntimeError("updateExtension batch failed: " + "; ".join(errs))
 
     # ----- Apply Config -----
-    def apply_config(self) -> dict:
+    async def apply_config(self) -> dict:
         gql_mutation = """
         mutation {
             doreload(input: {}) {
@@ -271,58 +802,95 @@ class FreePBX:
         }
         """
         try:
-            data = self.gql(gql_mutation)
+            data = await self.gql(gql_mutation)
             return data.get("doreload") or {"status": True, "message": "doreload ok"}
         except Exception as e1:
-            url = f"{self.base_url}/admin/ajax.php"
             try:
-                r = requests.get(url, params={"command": "reload"}, timeout=25, verify=self.verify)
-                r.raise_for_status()
-                try:
-                    return {"status": True, "message": str(r.json())[:400]}
-                except ValueError:
-                    return {"status": True, "message": r.text[:400]}
+                # тело ответа нужно только для короткого отчёта: читаем первые байты, остальное не качаем
+                async with self.client.stream("GET", self.ajax_url, params={"command": "reload"}, timeout=25) as r:
+                    r.raise_for_status()
+                    head = b""
+                    async for chunk in r.aiter_bytes():
+                        head += chunk
+                        if len(head) >= 512:
+                            break
+                    is_json = "json" in r.headers.get("content-type", "")
+                if is_json:
+                    try:
+                        return {"status": True, "message": str(orjson.loads(head))[:400]}
+                    except orjson.JSONDecodeError:
+                        pass  # ответ длиннее прочитанного — показываем как текст
+                return {"status": True, "message": head.decode("utf-8", "replace")[:400]}
             except Exception as e2:
                 raise RuntimeError(f"Apply Config failed: GraphQL doreload -> {e1}; ajax reload -> {e2}")
 
+    def schedule_apply(self, delay: float = APPLY_DEBOUNCE) -> asyncio.Future:
+        """
+        Ставит Apply Config с задержкой; каждый новый вызов в окне задержки
+        сдвигает её, так что пачка мутаций заканчивается одним reload.
+        Возвращает future с результатом (или исключением) этого reload.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._apply_waiters.append(fut)
+        # отменяем только задачу, которая ещё спит; идущий reload не трогаем — новый пройдёт следом
+        if self._apply_pending and not self._apply_pending.done():
+            self._apply_pending.cancel()
+        task = asyncio.create_task(self._delayed_apply(delay))
+        self._apply_pending = task
+        self._apply_tasks.add(task)
+        task.add_done_callback(self._apply_tasks.discard)
+        return fut
+
+    async def _delayed_apply(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if self._apply_pending is asyncio.current_task():
+            self._apply_pending = None
+        async with self._apply_lock:
+            waiters, self._apply_waiters = self._apply_waiters, []
+            if not waiters:
+                return
+            try:
+                res = await self.apply_config()
+            except Exception as e:
+                for w in waiters:
+                    if not w.done():
+                        w.set_exception(e)
+            else:
+                for w in waiters:
+                    if not w.done():
+                        w.set_result(res)
+
     # ----- Inbound Routes -----
-    def create_inbound_route(self, did: str, description: str, ext: str) -> None:
+    async def create_inbound_route(self, did: str, description: str, ext: str) -> None:
         did = str(did).strip()
         description = str(description).strip()
         ext = str(ext).strip()
 
-        candidates = [
-            f"from-did-direct,{ext},1",
-            f"ext-local,{ext},1",
-        ]
+        contexts = self._ordered("inbound_dest", ["from-did-direct", "ext-local"])
 
-        def _post_gql(mutation: str, variables: dict):
-            self.ensure_token()
-            h = {"Authorization": f"Bearer {self.token}"}
-            resp = requests.post(
-                self.gql_url,
-                json={"query": mutation, "variables": variables},
-                timeout=35,
-                verify=self.verify,
-                headers=h,
-            )
+        async def _post_gql(mutation: str, variables: dict):
+            self.invalidate_cache()
+            resp = await self._post(orjson.dumps({"query": mutation, "variables": variables}))
             text = resp.text
             try:
-                data = resp.json()
+                data = orjson.loads(resp.content)
             except Exception:
                 data = None
 
-            if not resp.ok:
+            if not resp.is_success:
                 lower = (text or "").lower()
                 if any(k in lower for k in ("already", "exist", "duplicate", "unique")):
                     raise AlreadyExists(text[:300])
-                resp.raise_for_status()
+                if not (isinstance(data, dict) and "errors" in data):
+                    resp.raise_for_status()  # ошибки GraphQL (в т.ч. с кодом 400) разбираются ниже
 
             if isinstance(data, dict) and "errors" in data:
                 joined = " | ".join(str(e.get("message", "")) for e in data["errors"])
                 lower = joined.lower()
                 if any(k in lower for k in ("already", "exist", "duplicate", "unique")):
                     raise AlreadyExists(joined[:300])
+                if data["errors"] and all(self._is_schema_error(e) for e in data["errors"]):
+                    raise FreePBXSchemaError(joined)
                 raise RuntimeError(joined or "GraphQL error")
 
             return data
@@ -341,15 +909,17 @@ class FreePBX:
         }"""
 
         last_err: Optional[Exception] = None
-        for dest in candidates:
+        for ctx in contexts:
+            # следующий контекст — только если запрос не прошёл валидацию схемы;
+            # ошибки резолвера, прав и транспорта — сразу наверх
             try:
-                _post_gql(mutation, {"did": did, "desc": description, "dest": dest})
-                return
-            except AlreadyExists:
-                raise
-            except Exception as e:
+                await _post_gql(mutation, {"did": did, "desc": description, "dest": f"{ctx},{ext},1"})
+            except FreePBXSchemaError as e:
+                self._drop_hint("inbound_dest", ctx)
                 last_err = e
                 continue
+            self._set_hint("inbound_dest", ctx)
+            return
 
         msg = str(last_err) if last_err else ""
         if "Cannot query field" in msg and "addInboundRoute" in msg:
@@ -360,7 +930,7 @@ class FreePBX:
         raise RuntimeError(f"create_inbound_route failed: {last_err}")
 
     # ===== Inbound Routes: find =====
-    def _try_fetch_inbound_routes(self) -> list:
+    async def _try_fetch_inbound_routes(self) -> list:
         queries = [
             """
             query {
@@ -385,9 +955,9 @@ class FreePBX:
             """,
         ]
         last_err = None
-        for q in queries:
+        for i in self._ordered("inbound_query", list(range(len(queries)))):
             try:
-                data = self.gql(q)
+                data = await self.gql(queries[i])
                 for key in ("fetchAllInboundRoutes", "inboundRoutes", "fetchInboundRoutes"):
                     if key in data and data[key] and "inboundRoute" in data[key]:
                         arr = data[key]["inboundRoute"] or []
@@ -399,21 +969,39 @@ class FreePBX:
                                 "description": str(r.get("description") or "").strip(),
                                 "destination": str(r.get("destination") or "").strip(),
                             })
+                        self._set_hint("inbound_query", i)
                         return out
-            except Exception as e:
+            except FreePBXSchemaError as e:
+                self._drop_hint("inbound_query", i)
                 last_err = e
                 continue
+        self._drop_hint("inbound_query")
         raise RuntimeError(f"Не удалось получить список inbound routes: {last_err}")
 
-    def find_inbound_route(self, did: str) -> Optional[dict]:
+    async def inbound_route_index(self) -> Dict[str, dict]:
+        """
+        {DID: маршрут} по _try_fetch_inbound_routes — тот же запрос и та же форма записей,
+        что у find_inbound_route без индекса. Строится один раз и живёт GQL_CACHE_TTL
+        секунд (или до любой мутации), так что сверка пачки DID — один запрос и поиск по словарю.
+        """
+        hit = self._inbound_index
+        if hit and time.monotonic() - hit[0] < GQL_CACHE_TTL:
+            return hit[1]
+        index = {r["extension"]: r for r in await self._try_fetch_inbound_routes() if r.get("extension")}
+        self._inbound_index = (time.monotonic(), index)
+        return index
+
+    async def find_inbound_route(self, did: str, index: Optional[Dict[str, dict]] = None) -> Optional[dict]:
         did = str(did).strip()
-        routes = self._try_fetch_inbound_routes()
+        if index is not None:
+            return index.get(did)
+        routes = await self._try_fetch_inbound_routes()
         for r in routes:
             if r.get("extension") == did:
                 return r
         return None
 
-    def delete_inbound_route(self, route_id: str):
+    async def delete_inbound_route(self, route_id: str):
         q = """
         mutation ($input: removeInboundRouteInput!) {
         removeInboundRoute(input: $input) {
@@ -423,10 +1011,10 @@ class FreePBX:
         }
         """
         variables = {"input": {"id": route_id}}
-        data = self.gql(q, variables)
+        data = await self.gql(q, variables)
         return data.get("removeInboundRoute") or {}
 
-    def list_inbound_routes(self):
+    async def list_inbound_routes(self):
         """
         Возвращает список inbound routes: id, extension, description
         """
@@ -441,7 +1029,7 @@ class FreePBX:
         }
         }
         """
-        data = self.gql(q)
+        data = await self.gql(q)
         conns = data.get("allInboundRoutes") or {}
         routes = conns.get("inboundRoutes") or []
         out = []
@@ -453,28 +1041,18 @@ class FreePBX:
             })
         return out
 
-    def list_query_fields(self):
-        q = """
-        query {
-        __schema {
-            queryType {
-            fields { name }
-            }
-        }
-        }
-        """
-        data = self.gql(q)
+    async def _schema_roots(self) -> Tuple[dict, dict]:
+        # обе выборки одним запросом: вторая команда подряд возьмёт свою из кэша
+        res = await self.gql_many([(_Q_QUERY_FIELDS, None), (_Q_MUTATIONS, None)])
+        for x in res:
+            if isinstance(x, Exception):
+                raise x
+        return res[0], res[1]
+
+    async def list_query_fields(self):
+        data, _ = await self._schema_roots()
         return [f["name"] for f in data["__schema"]["queryType"]["fields"]]
 
-    def list_mutations(self):
-        q = """
-        query {
-        __schema {
-            mutationType {
-            fields { name }
-            }
-        }
-        }
-        """
-        data = self.gql(q)
+    async def list_mutations(self):
+        _, data = await self._schema_roots()
         return [f["name"] for f in data["__schema"]["mutationType"]["fields"]]
@@ -1,10 +1,11 @@
 import base64
 import logging
 import re
+import threading
 import time
 from http.client import RemoteDisconnected
-from typing import Optional, Tuple
-from urllib.parse import urljoin, urlparse
+from typing import Dict, Iterable, Optional, Tuple
+from urllib.parse import quote_plus, urljoin, urlparse
 
 import requests
 from requests.adapters import HTTPAdapter
@@ -16,9 +17,146 @@ from requests.exceptions import (
 from urllib3.exceptions import ProtocolError
 from urllib3.util.retry import Retry
 
+try:
+    # один C-разбор страницы вместо прохода регулярками по каждому полю; без lxml — регулярки
+    from lxml import etree, html as lxhtml
+except ImportError:
+    lxhtml = None
+else:
+    # ParserError («Document is empty» и т.п.) — не ValueError
+    _LXML_ERRORS = (ValueError, TypeError, etree.LxmlError)
+    # имена отмеченных on-радиокнопок line<N>_fw_to_voip — отбор целиком на стороне libxml2
+    _FW_ON_XPATH = etree.XPath(
+        '//input[@checked and translate(@value, "ON", "on") = "on"'
+        ' and starts-with(@name, "line")'
+        ' and substring(@name, string-length(@name) - 10) = "_fw_to_voip"]/@name'
+    )
+
 
 log = logging.getLogger(__name__)
 
+# Сколько секунд страница ata_in_setting, прочитанная при проверке сохранения, считается
+# актуальной: следующее переключение слотов берёт её вместо нового GET формы
+FORM_TTL = 10.0
+# Прогрев корня/папки языка перед опросом статуса нужен только «остывшей» GoIP:
+# если последний успешный опрос был не раньше, чем столько секунд назад, его пропускаем
+WARMUP_AFTER = 60.0
+
+# Поля формы ata_in_setting по всем 32 линиям: текстовые/select (берём value)
+# и переключатели (берём checked).
+_LINE_VALUE_FIELDS = ("fw_num_to_voip", "gsm_cw", "gsm_group_mode", "gsm_fw_mode")
+_LINE_CHECKED_FIELDS = ("fw_to_voip", "auto_blacklist_in_enable")
+_LINE_DEFAULTS = {"fw_num_to_voip": "", "gsm_cw": "0", "gsm_group_mode": "DISABLE", "gsm_fw_mode": "0"}
+# POST формы ata_in_setting «по умолчанию»: служебные поля + все 32 линии с выключенными
+# переключателями и пустыми/заводскими значениями. Собирается один раз; на каждое сохранение
+# копируется и перезаписывается только тем, что прочитано со страницы.
+_FORM_TEMPLATE = {
+    "user_noinput_t": "60",
+    "cid_fw_mode": "1",
+    "submit": "Save",
+    "line_fw_conf_tab": "",
+    **{
+        f"line{i}_{key}": val
+        for i in range(1, 33)
+        for key, val in [*((k, "off") for k in _LINE_CHECKED_FIELDS), *_LINE_DEFAULTS.items()]
+    },
+}
+# Один проход по странице: каждый <input> любого из этих полей; линия — группа 1, поле — группа 2
+_LINE_INPUT_RE = re.compile(
+    r'<input\b[^>]*\bname="line(\d+)_(' + "|".join(_LINE_VALUE_FIELDS + _LINE_CHECKED_FIELDS) + r')"[^>]*>',
+    re.I,
+)
+_VALUE_ATTR_RE = re.compile(r'\bvalue="([^"]*)"', re.I)
+_CHECKED_RE = re.compile(r'\bchecked\b', re.I)
+
+# Признаки страницы статуса GoIP (ASCII — ищем прямо в байтах, без декодирования)
+_STATUS_MARKERS = (b"goip", b"status", b"imei", b"signal", b"module", b"gsm")
+
+
+def _stream_has_marker(r: requests.Response, markers=_STATUS_MARKERS, chunk_size: int = 8192) -> bool:
+    """
+    Ищет любой из маркеров в теле ответа (stream=True) по кускам, без сборки всей страницы.
+    Хвост предыдущего куска сохраняется, чтобы не пропустить маркер на стыке.
+    """
+    keep = max(len(m) for m in markers) - 1
+    tail = b""
+    for chunk in r.iter_content(chunk_size=chunk_size):
+        buf = tail + chunk.lower()
+        if any(m in buf for m in markers):
+            return True
+        tail = buf[-keep:]
+    return False
+
+
+def _encode_form(form_data: Dict[str, str]) -> bytes:
+    """
+    application/x-www-form-urlencoded тело для POST формы. Имена полей — ASCII без
+    спецсимволов, кодируем только значения; готовые bytes requests отправляет как есть.
+    """
+    return "&".join(f"{k}={quote_plus(v)}" for k, v in form_data.items()).encode("ascii")
+
+
+def _scan_line_fields(html: str) -> Tuple[dict, dict]:
+    """
+    ({поле: {линия: значение}}, {поле: {линии с checked}}) одним finditer по странице.
+    Для каждой линии берётся первое значение; fw_to_voip считается только у кнопки on.
+    """
+    values = {key: {} for key in _LINE_VALUE_FIELDS}
+    checked = {key: set() for key in _LINE_CHECKED_FIELDS}
+    for m in _LINE_INPUT_RE.finditer(html):
+        line, key, tag = int(m.group(1)), m.group(2).lower(), m.group(0)
+        v = _VALUE_ATTR_RE.search(tag)
+        if key in values:
+            if v is not None:
+                values[key].setdefault(line, v.group(1))
+        elif _CHECKED_RE.search(tag):
+            if key != "fw_to_voip" or (v is not None and v.group(1).lower() == "on"):
+                checked[key].add(line)
+    return values, checked
+
+
+_LINE_NAME_RE = re.compile(r"line(\d+)_(\w+)$")
+
+
+def _parse_line_fields(html: str) -> Tuple[dict, dict]:
+    """
+    То же, что _scan_line_fields, но через lxml: один разбор и один обход <input name=…>.
+    Если lxml нет или страница не разобралась — регулярки.
+    """
+    if lxhtml is None:
+        return _scan_line_fields(html)
+    try:
+        doc = lxhtml.fromstring(html)
+    except _LXML_ERRORS as e:
+        log.debug("GOIP form: lxml parse failed, falling back to regex: %s", e)
+        return _scan_line_fields(html)
+
+    values = {key: {} for key in _LINE_VALUE_FIELDS}
+    checked = {key: set() for key in _LINE_CHECKED_FIELDS}
+    for el in doc.iter("input"):
+        m = _LINE_NAME_RE.match(el.get("name") or "")
+        if not m:
+            continue
+        line, key = int(m.group(1)), m.group(2)
+        if key in values and el.get("value") is not None:
+            values[key].setdefault(line, el.get("value"))
+        elif key in checked and el.get("checked") is not None:
+            if key != "fw_to_voip" or (el.get("value") or "").lower() == "on":
+                checked[key].add(line)
+    return values, checked
+
+
+def _fw_to_voip_on(html: str) -> set:
+    """Слоты, у которых стоит checked на радиокнопке on «входящие в VoIP»."""
+    if lxhtml is not None:
+        try:
+            names = _FW_ON_XPATH(lxhtml.fromstring(html))
+        except _LXML_ERRORS as e:
+            log.debug("GOIP form: lxml parse failed, falling back to regex: %s", e)
+        else:
+            return {int(m.group(1)) for m in map(_LINE_NAME_RE.match, names) if m}
+    return _scan_line_fields(html)[1]["fw_to_voip"]
+
 
 class GoipStatus:
     READY = "ready"
@@ -26,6 +164,33 @@ class GoipStatus:
     ERROR = "error"
 
 
+# Браузерные заголовки: часть прошивок GoIP иначе отвечает обрывом. Ставятся сессии по умолчанию —
+# к каждому запросу добавляются только Referer и Authorization.
+_BROWSER_HEADERS = {
+    "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                   "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"),
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.8,ru;q=0.7",
+    "Cache-Control": "no-cache",
+    "Pragma": "no-cache",
+}
+
+
+def _basic_auth_variants(login: str, password: str) -> list[str]:
+    """
+    Возможные значения заголовка Authorization (utf-8, затем latin-1).
+    Нужно из-за символа '№' в пароле.
+    """
+    out = []
+    for enc in ("utf-8", "latin-1"):
+        try:
+            raw = f"{login}:{password}".encode(enc, "strict")
+            out.append("Basic " + base64.b64encode(raw).decode("ascii"))
+        except Exception:
+            pass
+    return out
+
+
 class GoIP:
     def __init__(self, base_url: str, login: str, password: str, verify: bool = False, timeout: int = 8):
         self.base_url = base_url.rstrip("/")
@@ -34,36 +199,61 @@ class GoIP:
         self.verify = verify
         self.timeout = timeout
         self.last_ok_at: float = 0.0
+        # base_url не меняется — адреса страниц считаем один раз
+        self._status_url = self._build_status_url()
+        self._ata_in_url = self._build_ata_in_url()
+        # Варианты Basic-заголовка считаем один раз; сработавший запоминаем и пробуем первым
+        self._auths = _basic_auth_variants(login, password)
+        self._auth_ok: Optional[str] = None
+        self._s: Optional[requests.Session] = None
+        # (monotonic-время, html) последней прочитанной формы ata_in_setting
+        self._form_cache: Optional[Tuple[float, str]] = None
+        self._form_lock = threading.Lock()
+
+    def __enter__(self) -> "GoIP":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if self._s is not None:
+            self._s.close()
+            self._s = None
 
     @property
     def status_url(self) -> str:
+        return self._status_url
+
+    def _build_status_url(self) -> str:
         parsed = urlparse(self.base_url)
         if parsed.path and parsed.path.lower().endswith(".html"):
             return self.base_url
         return urljoin(self.base_url + "/", "default/en_US/status.html")
 
     # ---------- internals ----------
-    def _auth_header_variants(self) -> list[str]:
+    def _auth_order(self) -> list[str]:
+        if self._auth_ok in self._auths:
+            return [self._auth_ok] + [a for a in self._auths if a != self._auth_ok]
+        return list(self._auths)
+
+    @property
+    def session(self) -> requests.Session:
         """
-        Возвращает список возможных значений заголовка Authorization (utf-8, затем latin-1).
-        Нужно из-за символа '№' в пароле.
+        Одна сессия на экземпляр: keep-alive между запросами (прогрев, форма, POST,
+        проверка) вместо нового TCP/TLS-соединения на каждый.
+        Без прокси из окружения, с мягкими ретраями на 502/503/504 и обрывы —
+        они же покрывают случай, когда GoIP закрыла простаивавшее соединение.
         """
-        out = []
-        for enc in ("utf-8", "latin-1"):
-            try:
-                raw = f"{self.login}:{self.password}".encode(enc, "strict")
-                out.append("Basic " + base64.b64encode(raw).decode("ascii"))
-            except Exception:
-                pass
-        return out
+        if self._s is None:
+            self._s = self._session()
+        return self._s
 
     def _session(self) -> requests.Session:
-        """
-        Сессия без keep-alive (будем слать Connection: close),
-        без прокси из окружения, с мягкими ретраями на 502/503/504.
-        """
         s = requests.Session()
         s.trust_env = False  # игнорировать прокси переменные окружения
+        s.verify = self.verify
+        s.headers.update(_BROWSER_HEADERS)
 
         retry = Retry(
             total=2,
@@ -73,25 +263,12 @@ class GoIP:
             raise_on_status=False,
             respect_retry_after_header=True,
         )
-        adapter = HTTPAdapter(max_retries=retry, pool_maxsize=4, pool_block=False)
+        # пул соединений на хост (до 4 хостов — на случай редиректов), по 4 сокета в каждом
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=4, pool_maxsize=4, pool_block=False)
         s.mount("http://", adapter)
         s.mount("https://", adapter)
         return s
 
-    def _common_headers(self, referer: Optional[str] = None) -> dict:
-        h = {
-            "User-Agent": ("Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                           "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"),
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "Accept-Language": "en-US,en;q=0.8,ru;q=0.7",
-            "Cache-Control": "no-cache",
-            "Pragma": "no-cache",
-            "Connection": "close",
-        }
-        if referer:
-            h["Referer"] = referer
-        return h
-
     # ---------- optional radmin warm-up ----------
     @staticmethod
     def warmup_radmin(radmin_url: str, login: str, password: str,
@@ -101,16 +278,6 @@ class GoIP:
         затем без авторизации. Цель — чтобы Радмин зафиксировал внешний IP и
         пропустил далее к GoIP.
         """
-        def _auth_variants(u, p):
-            res = []
-            for enc in ("utf-8", "latin-1"):
-                try:
-                    raw = f"{u}:{p}".encode(enc, "strict")
-                    res.append("Basic " + base64.b64encode(raw).decode("ascii"))
-                except Exception:
-                    pass
-            return res
-
         headers_base = {
             "User-Agent": "Mozilla/5.0",
             "Accept": "*/*",
@@ -122,7 +289,7 @@ class GoIP:
             with requests.Session() as s:
                 s.trust_env = False
                 # 1) Пара попыток с Basic-Auth
-                for ah in _auth_variants(login, password):
+                for ah in _basic_auth_variants(login, password):
                     h = {**headers_base, "Authorization": ah}
                     try:
                         r = s.get(radmin_url, headers=h, timeout=(3, timeout),
@@ -144,9 +311,10 @@ class GoIP:
     def check_status(self) -> Tuple[str, str, int]:
         """
         Проверяет доступность /status.html. Возвращает (статус, сообщение, http_code).
-        Делает короткий «разогрев» каталога, один мягкий ретрай при обрыве.
+        Делает короткий «разогрев» каталога (если последний успешный опрос был
+        больше WARMUP_AFTER сек назад), один мягкий ретрай при обрыве.
         """
-        auths = self._auth_header_variants()
+        auths = self._auth_order()
         if not auths:
             return GoipStatus.ERROR, "Не удалось закодировать логин/пароль (utf-8/latin-1).", 0
 
@@ -155,36 +323,40 @@ class GoIP:
         read_to = max(self.timeout, 15)
 
         last_exc = None
-        with self._session() as s:
-            for ah in auths:
-                headers = {**self._common_headers(referer=url), "Authorization": ah}
+        s = self.session
+        if time.time() - self.last_ok_at > WARMUP_AFTER:
+            # «Разогрев» некоторых прошивок: дернуть корень и папку языка.
+            # HEAD — без тел страниц; после недавнего успешного опроса не нужен вовсе
+            root = url.split("/default/")[0] + "/"
+            headers = {"Referer": url, "Authorization": auths[0]}
+            try:
+                s.head(root, headers=headers, timeout=(3, 5), allow_redirects=False)
+                s.head(root + "default/en_US/", headers=headers, timeout=(3, 5), allow_redirects=False)
+            except requests.RequestException:
+                pass  # прогрев опционален
+
+        for ah in auths:
+            headers = {"Referer": url, "Authorization": ah}
+            for _ in range(2):  # одна повторная попытка при обрыве
                 try:
-                    # «Разогрев» некоторых прошивок: дернуть корень и папку языка
-                    root = url.split("/default/")[0] + "/"
-                    s.get(root, headers=headers, timeout=(3, 5), verify=self.verify, allow_redirects=False)
-                    s.get(root + "default/en_US/", headers=headers, timeout=(3, 5), verify=self.verify, allow_redirects=False)
-                except requests.RequestException:
-                    pass  # прогрев опционален
-
-                for _ in range(2):  # одна повторная попытка при обрыве
-                    try:
-                        r = s.get(url, headers=headers, timeout=(connect_to, read_to),
-                                  verify=self.verify, allow_redirects=False)
+                    with s.get(url, headers=headers, timeout=(connect_to, read_to),
+                               verify=self.verify, allow_redirects=False, stream=True) as r:
                         code = r.status_code
                         if code in (401, 403):
                             break  # пробуем следующую кодировку
                         if code != 200:
                             return GoipStatus.ERROR, f"Неожиданный код ответа: {code}", code
+                        # читаем страницу кусками и останавливаемся на первом признаке
+                        found = _stream_has_marker(r)
+                    if found:
+                        self.last_ok_at = time.time()
+                        self._auth_ok = ah
+                        return GoipStatus.READY, "GOIP готова (страница статуса доступна).", 200
+                    return GoipStatus.ERROR, "HTTP 200, но не похоже на статус GOIP.", 200
 
-                        body = (r.text or "").lower()
-                        if any(m in body for m in ("goip", "status", "imei", "signal", "module", "gsm")):
-                            self.last_ok_at = time.time()
-                            return GoipStatus.READY, "GOIP готова (страница статуса доступна).", 200
-                        return GoipStatus.ERROR, "HTTP 200, но не похоже на статус GOIP.", 200
-
-                    except (ReadTimeout, ConnectTimeout, ReqConnectionError, ProtocolError, RemoteDisconnected, ConnectionResetError) as e:
-                        last_exc = e
-                        time.sleep(0.35)
+                except (ReadTimeout, ConnectTimeout, ReqConnectionError, ProtocolError, RemoteDisconnected, ConnectionResetError) as e:
+                    last_exc = e
+                    time.sleep(0.35)
 
         return GoipStatus.ERROR, f"Сетевой сбой: {last_exc}", 0
 
@@ -192,6 +364,9 @@ class GoIP:
         """
         URL страницы настроек входящих (ata_in_setting).
         """
+        return self._ata_in_url
+
+    def _build_ata_in_url(self) -> str:
         p = urlparse(self.base_url)
         root = f"{p.scheme}://{p.netloc}"
         parts = [seg for seg in p.path.strip("/").split("/") if seg]
@@ -201,66 +376,75 @@ class GoIP:
         return f"{root}/{lang_prefix}/config.html?type=ata_in_setting"
 
     def set_incoming_enabled(self, slot: int, enabled: bool) -> Tuple[bool, str]:
+        return self.set_incoming_enabled_many([slot], enabled)[slot]
+
+    def set_incoming_enabled_many(self, slots: Iterable[int], enabled: bool) -> Dict[int, Tuple[bool, str]]:
         """
         Безопасный способ: читаем форму, копируем значения всех 32 каналов,
-        меняем только нужный слот, шлём все поля, затем валидируем изменившийся флаг.
+        меняем только нужные слоты, шлём все поля, затем валидируем изменившиеся флаги
+        (по странице, которую вернул POST, или повторным GET).
+        Форма одна на все каналы, поэтому пачка слотов — те же запросы, что и один слот
+        (а параллельные POST по слотам затирали бы друг друга).
+        Возвращает {слот: (ok, сообщение)}.
         """
-        if slot < 1 or slot > 32:
-            return False, "Слот вне диапазона 1..32"
+        out: Dict[int, Tuple[bool, str]] = {}
+        todo = []
+        for slot in dict.fromkeys(slots):
+            if slot < 1 or slot > 32:
+                out[slot] = (False, "Слот вне диапазона 1..32")
+            else:
+                todo.append(slot)
+        if not todo:
+            return out
+        # вызовы идут из пула потоков: два переключения одной GoIP не должны перемешать
+        # чтение формы и её сохранение (второй POST затёр бы первый)
+        with self._form_lock:
+            return self._save_slots(todo, enabled, out)
+
+    def _save_slots(self, todo: list, enabled: bool, out: Dict[int, Tuple[bool, str]]) -> Dict[int, Tuple[bool, str]]:
+        def _all(ok: bool, msg: str) -> Dict[int, Tuple[bool, str]]:
+            out.update({slot: (ok, msg) for slot in todo})
+            return out
 
         url = self.ata_in_url()
         connect_to = 5
         read_to = max(self.timeout, 25)
 
-        with self._session() as s:
-            for ah in self._auth_header_variants():
-                h_base = {**self._common_headers(referer=url), "Authorization": ah}
-                try:
-                    # 1) GET формы
+        s = self.session
+        for ah in self._auth_order():
+            h_base = {"Referer": url, "Authorization": ah}
+            try:
+                # 1) Форма: свежая копия с прошлой проверки или GET.
+                # Шлём всё равно полную форму — частичный POST на части прошивок сбрасывает остальные линии.
+                cached, self._form_cache = self._form_cache, None
+                if cached and ah == self._auth_ok and time.monotonic() - cached[0] < FORM_TTL:
+                    html = cached[1]
+                else:
                     gr = s.get(url, headers=h_base, timeout=(connect_to, read_to),
                                verify=self.verify, allow_redirects=True)
                     if gr.status_code in (401, 403):
                         continue  # пробуем другой вариант кодировки
                     if gr.status_code != 200:
-                        return False, f"Не удалось открыть форму (HTTP {gr.status_code})"
+                        return _all(False, f"Не удалось открыть форму (HTTP {gr.status_code})")
                     html = gr.text
 
-                    # 2) Собираем значения всех 32 слотов
-                    form_data = {
-                        "user_noinput_t": "60",
-                        "cid_fw_mode": "1",
-                        "submit": "Save",
-                        "line_fw_conf_tab": f"line{slot}_fw_conf",  # активная вкладка = наш слот
-                    }
-                    for i in range(1, 33):
-                        # radio on/off
-                        form_data[f"line{i}_fw_to_voip"] = (
-                            "on" if re.search(
-                                rf'name="line{i}_fw_to_voip"\s+value="on"[^>]*checked',
-                                html, flags=re.I
-                            ) else "off"
-                        )
-                        # alias
-                        m = re.search(rf'name="line{i}_fw_num_to_voip"[^>]*value="([^"]*)"', html, flags=re.I)
-                        form_data[f"line{i}_fw_num_to_voip"] = m.group(1) if m else ""
-                        # cw
-                        m = re.search(rf'name="line{i}_gsm_cw"[^>]*value="([^"]*)"', html, flags=re.I)
-                        form_data[f"line{i}_gsm_cw"] = m.group(1) if m else "0"
-                        # group mode
-                        m = re.search(rf'name="line{i}_gsm_group_mode"[^>]*value="([^"]*)"', html, flags=re.I)
-                        form_data[f"line{i}_gsm_group_mode"] = m.group(1) if m else "DISABLE"
-                        # fw mode
-                        m = re.search(rf'name="line{i}_gsm_fw_mode"[^>]*value="([^"]*)"', html, flags=re.I)
-                        form_data[f"line{i}_gsm_fw_mode"] = m.group(1) if m else "0"
-                        # blacklist (checkbox)
-                        form_data[f"line{i}_auto_blacklist_in_enable"] = (
-                            "on" if re.search(
-                                rf'name="line{i}_auto_blacklist_in_enable"[^>]*checked',
-                                html, flags=re.I
-                            ) else "off"
-                        )
-
-                    # 3) Меняем только нужный слот
+                # 2) Значения всех 32 слотов: шаблон с умолчаниями + то, что есть на странице
+                form_data = _FORM_TEMPLATE.copy()
+                form_data["line_fw_conf_tab"] = f"line{todo[0]}_fw_conf"  # активная вкладка = наш слот
+                values, checked = _parse_line_fields(html)
+                # radio on/off, blacklist (checkbox)
+                for key, lines in checked.items():
+                    for i in lines:
+                        if 1 <= i <= 32:
+                            form_data[f"line{i}_{key}"] = "on"
+                # alias, cw, group mode, fw mode
+                for key, found in values.items():
+                    for i, val in found.items():
+                        if 1 <= i <= 32:
+                            form_data[f"line{i}_{key}"] = val
+
+                # 3) Меняем только нужные слоты
+                for slot in todo:
                     if enabled:
                         form_data[f"line{slot}_fw_to_voip"] = "on"
                         if not form_data.get(f"line{slot}_fw_num_to_voip"):
@@ -269,39 +453,44 @@ class GoIP:
                         form_data[f"line{slot}_fw_to_voip"] = "off"
                         form_data[f"line{slot}_fw_num_to_voip"] = ""
 
-                    # 4) POST всей формы
-                    h_post = {**h_base, "Content-Type": "application/x-www-form-urlencoded"}
-                    pr = s.post(url, headers=h_post, data=form_data,
-                                timeout=(connect_to, read_to), verify=self.verify, allow_redirects=True)
-                    if pr.status_code not in (200, 302):
-                        return False, f"HTTP {pr.status_code}: устройство не приняло изменения."
-
-                    # 5) Верификация — повторный GET и поиск checked у on-радиокнопки
+                # 4) POST всей формы
+                h_post = {**h_base, "Content-Type": "application/x-www-form-urlencoded"}
+                pr = s.post(url, headers=h_post, data=_encode_form(form_data),
+                            timeout=(connect_to, read_to), verify=self.verify, allow_redirects=True)
+                if pr.status_code in (401, 403):
+                    self._auth_ok = None
+                    continue  # форма была из кэша, а авторизация уже не та
+                if pr.status_code not in (200, 302):
+                    return _all(False, f"HTTP {pr.status_code}: устройство не приняло изменения.")
+
+                # 5) Верификация — поиск checked у on-радиокнопки. Большинство прошивок
+                # отвечают на Save той же формой: тогда проверяем по ответу POST,
+                # повторный GET — только если в ответе формы нет
+                html = pr.text if pr.status_code == 200 else ""
+                if f'line{todo[0]}_fw_to_voip"' not in html:
                     vr = s.get(url, headers=h_base, timeout=(connect_to, read_to),
                                verify=self.verify, allow_redirects=True)
                     if vr.status_code != 200:
-                        return False, f"Сохранение прошло, но проверка не удалась (HTTP {vr.status_code})."
-
-                    pat = re.compile(
-                        rf'<input\b[^>]*name="line{slot}_fw_to_voip"[^>]*value="on"[^>]*>',
-                        flags=re.I
-                    )
-                    checked = False
-                    for m in pat.finditer(vr.text):
-                        if re.search(r'\bchecked\b', m.group(0), flags=re.I):
-                            checked = True
-                            break
+                        return _all(False, f"Сохранение прошло, но проверка не удалась (HTTP {vr.status_code}).")
+                    html = vr.text
 
+                self._form_cache = (time.monotonic(), html)
+                on_slots = _fw_to_voip_on(html)
+                for slot in todo:
+                    checked = slot in on_slots
                     if enabled and not checked:
-                        return False, "Не удалось включить: после сохранения флаг всё ещё OFF."
-                    if not enabled and checked:
-                        return False, "Не удалось отключить: после сохранения флаг всё ещё ON."
+                        out[slot] = (False, "Не удалось включить: после сохранения флаг всё ещё OFF.")
+                    elif not enabled and checked:
+                        out[slot] = (False, "Не удалось отключить: после сохранения флаг всё ещё ON.")
+                    else:
+                        out[slot] = (True, f"{'Включены' if enabled else 'Отключены'} входящие для слота {slot}.")
 
-                    return True, f"{'Включены' if enabled else 'Отключены'} входящие для слота {slot}."
+                self._auth_ok = ah
+                return out
 
-                except (ReadTimeout, ConnectTimeout, ReqConnectionError, ProtocolError, RemoteDisconnected, ConnectionResetError) as e:
-                    # мягкая пауза и попробуем другую кодировку базик-аута (если есть)
-                    log.warning("GOIP network hiccup on set_incoming_enabled: %s", e)
-                    time.sleep(0.35)
+            except (ReadTimeout, ConnectTimeout, ReqConnectionError, ProtocolError, RemoteDisconnected, ConnectionResetError) as e:
+                # мягкая пауза и попробуем другую кодировку базик-аута (если есть)
+                log.warning("GOIP network hiccup on set_incoming_enabled: %s", e)
+                time.sleep(0.35)
 
-        return False, "Сетевая ошибка при попытке применить изменения (GOIP рвёт соединение)."
+        return _all(False, "Сетевая ошибка при попытке применить изменения (GOIP рвёт соединение).")
@@ -0,0 +1,143 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, Optional
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclass(slots=True)
+class Session:
+    """Состояние подключения чата к FreePBX."""
+    base_url: str
+    client_id: str
+    client_secret: str
+    verify: bool
+    token: Optional[str] = None
+    token_exp: float = 0.0
+    ssh: Optional[dict] = None
+    schema_hints: Dict[str, object] = field(default_factory=dict)
+    # живые объекты процесса — на диск не пишутся
+    fb: Any = None
+    list_pages: Optional[tuple] = None
+
+
+class SessionStore(MutableMapping):
+    """
+    Сессии чатов: живые Session в памяти + SQLite (WAL) на диске, чтобы /connect
+    переживал рестарт и был виден другим процессам бота с той же базой.
+
+    На диск пишутся только PERSIST_KEYS; HTTP-клиент и прочие живые объекты
+    каждый процесс создаёт сам (лениво). В памяти — не больше MAX_LIVE сессий (LRU),
+    вытесненные читаются из базы заново. Токен тоже сохраняется: пока он не истёк,
+    после рестарта он берётся из базы без запроса к token endpoint.
+    """
+
+    PERSIST_KEYS = ("base_url", "client_id", "client_secret", "verify", "ssh", "schema_hints",
+                    "token", "token_exp")
+    # Сколько помнить, что у чата нет сессии: не лезем в SQLite на каждое сообщение
+    # неподключённого чата (сессия, созданная другим процессом, станет видна через это время)
+    MISS_TTL = 30.0
+    # Сколько сессий держать в памяти: давно не писавшие чаты вытесняются (LRU) и при
+    # следующем сообщении лениво поднимаются из SQLite
+    MAX_LIVE = 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mem: "OrderedDict[int, Session]" = OrderedDict()
+        self._misses: "OrderedDict[int, float]" = OrderedDict()
+        # В базе секреты API и токены, а в WAL они попадают раньше, чем в сам файл:
+        # база, -wal и -shm создаются только с правами владельца
+        old_umask = os.umask(0o077)
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " chat_id INTEGER PRIMARY KEY,"
+                " data TEXT NOT NULL,"
+                " updated REAL NOT NULL)"
+            )
+        finally:
+            os.umask(old_umask)
+        # файлы, оставшиеся от прежних запусков, могли быть созданы с umask по умолчанию
+        for p in (path, f"{path}-wal", f"{path}-shm"):
+            try:
+                os.chmod(p, 0o600)
+            except OSError:
+                pass
+
+    def _load(self, chat_id: int) -> Optional[Session]:
+        missed = self._misses.get(chat_id)
+        if missed is not None and time.monotonic() - missed < self.MISS_TTL:
+            return None
+        row = self._db.execute("SELECT data FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        if not row:
+            self._misses[chat_id] = time.monotonic()
+            self._misses.move_to_end(chat_id)
+            if len(self._misses) > self.MAX_LIVE:
+                self._misses.popitem(last=False)
+            return None
+        self._misses.pop(chat_id, None)
+        try:
+            data = json.loads(row[0])
+            s = Session(**{k: data[k] for k in self.PERSIST_KEYS if k in data})
+        except (ValueError, TypeError) as e:
+            log.warning(f"Broken session row for {chat_id}: {e}")
+            return None
+        self._remember(chat_id, s)
+        return s
+
+    def _remember(self, chat_id: int, sess: Session) -> None:
+        self._mem[chat_id] = sess
+        self._mem.move_to_end(chat_id)
+        while len(self._mem) > self.MAX_LIVE:
+            # на диске сессия остаётся; общий HTTP-клиент процесса закрывать не нужно
+            self._mem.popitem(last=False)
+
+    def save(self, chat_id: int) -> None:
+        """Сбросить на диск текущее состояние сессии (после правок «на месте»)."""
+        s = self._mem.get(chat_id)
+        if s is None:
+            return
+        data = {k: getattr(s, k) for k in self.PERSIST_KEYS}
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (chat_id, data, updated) VALUES (?, ?, ?)",
+            (chat_id, json.dumps(data, ensure_ascii=False), time.time()),
+        )
+
+    # ----- MutableMapping -----
+    def __getitem__(self, chat_id: int) -> Session:
+        s = self._mem.get(chat_id)
+        if s is None:
+            s = self._load(chat_id)
+        else:
+            self._mem.move_to_end(chat_id)
+        if s is None:
+            raise KeyError(chat_id)
+        return s
+
+    def __setitem__(self, chat_id: int, sess: Session) -> None:
+        self._remember(chat_id, sess)
+        self._misses.pop(chat_id, None)
+        self.save(chat_id)
+
+    def __delitem__(self, chat_id: int) -> None:
+        in_mem = self._mem.pop(chat_id, None) is not None
+        cur = self._db.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+        if not in_mem and cur.rowcount == 0:
+            raise KeyError(chat_id)
+
+    def __iter__(self) -> Iterator[int]:
+        ids = set(self._mem)
+        ids.update(r[0] for r in self._db.execute("SELECT chat_id FROM sessions"))
+        return iter(ids)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
@@ -1,4 +1,4 @@
-import socket, sys, time
+import re, select, socket, sys, time
 
 GOIP_IP = "185.191.56.153"
 UDP_PORT = 5060
@@ -6,37 +6,52 @@ TCP_PORT = 5060
 TIMEOUT = 5
 RETRIES = 3
 
-def sip_options_udp(ip, port=UDP_PORT, timeout=TIMEOUT, retries=RETRIES):
-    msg = f"""OPTIONS sip:{ip} SIP/2.0
-Via: SIP/2.0/UDP 0.0.0.0:5060;branch=z9hG4bKcheck;rport
-From: <sip:probe@local>;tag=12345
-To: <sip:{ip}>
-Call-ID: probe-{int(time.time())}@local
-CSeq: 1 OPTIONS
-Max-Forwards: 70
-Content-Length: 0
+# SIP требует CRLF в конце строк; Call-ID подставляется на каждый вызов
+_OPTIONS_TEMPLATE = (
+    b"OPTIONS sip:%s SIP/2.0\r\n"
+    b"Via: SIP/2.0/UDP 0.0.0.0:5060;branch=z9hG4bKcheck;rport\r\n"
+    b"From: <sip:probe@local>;tag=12345\r\n"
+    b"To: <sip:%s>\r\n"
+    b"Call-ID: probe-%d@local\r\n"
+    b"CSeq: 1 OPTIONS\r\n"
+    b"Max-Forwards: 70\r\n"
+    b"Content-Length: 0\r\n"
+    b"\r\n"
+)
 
-"""
-    data = msg.encode("ascii", "ignore")
+# Call-ID в ответе (в т.ч. компактная форма «i:») — по нему ответ сопоставляется с целью
+_CALL_ID_RE = re.compile(rb"^(?:Call-ID|i)[ \t]*:[ \t]*probe-(\d+)@local", re.I | re.M)
+
+def sip_options_udp(ip, port=UDP_PORT, timeout=TIMEOUT, retries=RETRIES, sock=None):
+    host = ip.encode("ascii", "ignore")
+    data = _OPTIONS_TEMPLATE % (host, host, int(time.time()))
+    if sock is not None:
+        return _probe_udp(sock, data, ip, port, retries)
+    with open_udp_socket(timeout) as sock:
+        return _probe_udp(sock, data, ip, port, retries)
+
+def open_udp_socket(timeout=TIMEOUT):
+    """UDP-сокет для проб: можно открыть один и передавать в sip_options_udp(sock=...)."""
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         sock.bind(("", 5060))
     except OSError:
         pass
     sock.settimeout(timeout)
+    return sock
 
+def _probe_udp(sock, data, ip, port, retries):
     last_err = None
     for i in range(1, retries+1):
         try:
             sock.sendto(data, (ip, port))
             resp, _ = sock.recvfrom(4096)
-            text = resp.decode("ascii", "ignore")
-            if "SIP/2.0 200" in text:
+            if b"SIP/2.0 200" in resp:
                 print(f"[OK:UDP] Получен ответ 200 OK за попытку {i}")
-                print("\n".join(text.splitlines()[:6]))
+                print("\n".join(resp.decode("ascii", "ignore").splitlines()[:6]))
                 return True
             else:
-                print(f"[UDP] Ответ получен, но не 200 OK:\n{text[:200]}")
+                print(f"[UDP] Ответ получен, но не 200 OK:\n{resp[:200].decode('ascii', 'ignore')}")
                 return False
         except socket.timeout:
             print(f"[UDP] Таймаут (попытка {i}/{retries})")
@@ -46,7 +61,46 @@ Content-Length: 0
             last_err = str(e)
     print(f"[FAIL:UDP] Нет ответа по UDP/5060: {last_err}")
     return False
-    sock.close()
+
+def sip_options_many(ips, port=UDP_PORT, timeout=TIMEOUT, retries=RETRIES):
+    """
+    OPTIONS сразу ко всем ips с одного UDP-сокета: у каждой цели свой Call-ID,
+    ответы разбираются по нему. Вся проверка занимает ~timeout на попытку,
+    а не timeout × число устройств. Возвращает {ip: получен ли 200 OK}.
+    """
+    base = int(time.time()) * 1000
+    msgs, pending = {}, {}
+    for n, ip in enumerate(ips):
+        host = ip.encode("ascii", "ignore")
+        nonce = base + n
+        msgs[ip] = _OPTIONS_TEMPLATE % (host, host, nonce)
+        pending[b"%d" % nonce] = ip
+    results = dict.fromkeys(ips, False)
+
+    with open_udp_socket(timeout) as sock:
+        for _ in range(retries):
+            for ip in pending.values():
+                try:
+                    sock.sendto(msgs[ip], (ip, port))
+                except OSError as e:
+                    print(f"[UDP] {ip}: ошибка отправки: {e}")
+            deadline = time.monotonic() + timeout
+            while pending:
+                left = deadline - time.monotonic()
+                if left <= 0 or not select.select([sock], [], [], left)[0]:
+                    break
+                try:
+                    resp, _ = sock.recvfrom(4096)
+                except OSError:
+                    continue
+                m = _CALL_ID_RE.search(resp)
+                ip = pending.pop(m.group(1), None) if m else None
+                if ip is not None:
+                    # ответ не 200 — устройство живо, но повторять не нужно
+                    results[ip] = b"SIP/2.0 200" in resp
+            if not pending:
+                break
+    return results
 
 def sip_tcp_probe(ip, port=TCP_PORT, timeout=TIMEOUT):
     try:
@@ -59,6 +113,11 @@ def sip_tcp_probe(ip, port=TCP_PORT, timeout=TIMEOUT):
         return False
 
 if __name__ == "__main__":
+    if len(sys.argv) > 2:
+        for ip, ok in sip_options_many(sys.argv[1:]).items():
+            print(f"{ip}: {'200 OK' if ok else 'нет ответа 200'}")
+        sys.exit(0)
+    GOIP_IP = sys.argv[1] if len(sys.argv) > 1 else GOIP_IP
     ok_udp = sip_options_udp(GOIP_IP)
     ok_tcp = sip_tcp_probe(GOIP_IP)
     if not ok_udp and not ok_tcp:
@@ -1,40 +1,30 @@
 from html import escape
-from typing import List, Tuple
 
 from telegram import Update
 from telegram.constants import ChatAction
 from telegram.ext import ContextTypes
 
 from .commands import (
+    _apply_in_background,
+    _delete_exts_batched,
+    _edit_quietly,
     _ensure_connected,
-    _slice_pairs,
+    _render_list,
     fb_from_session,
+    SESS,
 )
-from ui.texts import _list_nav_kb, _list_page_text
-from utils.common import clean_url
 
 
 async def list_nav_cb(u: Update, c: ContextTypes.DEFAULT_TYPE):
+    # сюда попадают только list:page:* — фильтрует pattern в CallbackQueryHandler
     q = u.callback_query
     data = q.data
-    if not data.startswith("list:page:"):
-        await q.answer()
-        return
-
     try:
         page = int(data.split(":")[-1])
 
-        pairs: List[Tuple[str, str]] = c.user_data.get("__last_pairs")
         fb = fb_from_session(u.effective_chat.id)
-        if pairs is None:
-            pairs = fb.fetch_all_extensions()
-            c.user_data["__last_pairs"] = pairs
-
-        pairs_page, page, pages = _slice_pairs(pairs, page=page)
-        await q.message.edit_text(
-            _list_page_text(clean_url(fb.base_url), pairs_page),
-            reply_markup=_list_nav_kb(page, pages)
-        )
+        text, kb = await _render_list(u.effective_chat.id, fb, page=page)
+        await q.message.edit_text(text, reply_markup=kb)
         await q.answer()
     except Exception:
         await q.answer("Ошибка")
@@ -45,58 +35,46 @@ async def del_all_cb(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
 
     q = u.callback_query
-    if not q.data.startswith("delall:"):
-        await q.answer()
-        return
-
     answer = q.data.split(":")[1]
     if answer == "no":
         await q.edit_message_text("Отменено.")
         await q.answer("Отмена")
         return
 
+    # отвечаем на callback сразу: после долгого удаления query уже «too old»,
+    # и поздний answer() уронил бы итоговое сообщение в ветку ошибки
+    await q.answer("Удаляю…")
     try:
         fb = fb_from_session(u.effective_chat.id)
         await q.edit_message_text("⏳ Удаляю все линии… (подготовка)")
-        pairs = fb.fetch_all_extensions()
+        # список — одним запросом и заведомо свежий: из кэша gql могли бы прийти уже
+        # удалённые в другом месте EXT, и они попали бы в «не удалось удалить»
+        fb.invalidate_cache()
+        pairs = await fb.fetch_all_extensions()
         total = len(pairs)
-        done = 0
-
-        await q.message.chat.send_action(ChatAction.TYPING)
-        for ext, _ in pairs:
-            try:
-                fb.delete_extension(ext)
-            except Exception:
-                pass
-            done += 1
-            if done % 25 == 0 or done == total:
-                try:
-                    await q.edit_message_text(f"⏳ Удаляю все линии… ({done}/{total})")
-                except Exception:
-                    pass
 
-        if total:
-            try:
-                try:
-                    await q.edit_message_text("🔄 Применяю конфиг (Apply Config)…")
-                except Exception:
-                    pass
-                fb.apply_config()
-            except Exception as e:
-                try:
-                    await q.edit_message_text(
-                        f"Удаление выполнено, но Apply Config не удалось: <code>{escape(str(e))}</code>"
-                    )
-                except Exception:
-                    pass
-                await q.answer("Ошибка Apply Config")
-                return
+        async def _progress(done):
+            await _edit_quietly(q.edit_message_text, f"⏳ Удаляю все линии… ({done}/{total})")
 
-        await q.edit_message_text(f"{fb.base_url}\n\n(всё удалено)")
-        await q.answer("Готово")
+        await q.message.chat.send_action(ChatAction.TYPING)
+        ok, failed = await _delete_exts_batched(fb, [ext for ext, _ in pairs], _progress)
+        sess = SESS.get(u.effective_chat.id)
+        if sess:
+            sess.list_pages = None
+
+        summary = f"{fb.base_url}\n\n(всё удалено)"
+        if failed:
+            summary = (
+                f"{fb.base_url}\n\nУдалено: {len(ok)} из {total}\n"
+                f"❌ Не удалось: {escape(', '.join(failed[:50]))}{' …' if len(failed) > 50 else ''}"
+            )
+        if ok:
+            await q.edit_message_text(f"{summary}\n🔄 Apply Config запланирован…")
+            _apply_in_background(c, fb, q.edit_message_text, summary)
+        else:
+            await q.edit_message_text(summary)
     except Exception as e:
-        await q.edit_message_text(f"Ошибка удаления: <code>{escape(str(e))}</code>")
-        await q.answer("Ошибка")
+        await _edit_quietly(q.edit_message_text, f"Ошибка удаления: <code>{escape(str(e))}</code>")
 
 
 async def noop_cb(u: Update, c: ContextTypes.DEFAULT_TYPE):
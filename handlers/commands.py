@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import json
 import logging
 import os
@@ -6,6 +7,8 @@ import re
 import secrets
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from html import escape
 from pathlib import Path
 from typing import Dict
@@ -16,12 +19,10 @@ from telegram import (
     BotCommandScopeAllChatAdministrators,
     BotCommandScopeAllGroupChats,
     BotCommandScopeAllPrivateChats,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    ReplyKeyboardRemove,
     Update,
 )
 from telegram.constants import ChatAction, ParseMode
+from telegram.error import RetryAfter
 from telegram.ext import Application, ContextTypes
 
 from core.asterisk import (
@@ -30,22 +31,26 @@ from core.asterisk import (
     fetch_endpoint_raw_via_ssh,
     fetch_goip_ips_via_ssh,
     fetch_pjsip_endpoints_via_ssh,
-    set_extension_chansip_secret_via_ssh,
+    reload_freepbx,
+    set_extension_chansip_secrets_bulk_via_ssh,
     set_incoming_trunk_sip_server_via_ssh,
     create_outbound_route_with_ranges_via_ssh,
 )
-from core.freepbx import AlreadyExists, FreePBX
+from core.freepbx import GQL_BATCH_SIZE, GQL_CACHE_TTL, AlreadyExists, FreePBX, FreePBXAuthError, aclose_shared_clients
 from core.goip import GoIP, GoipStatus
+from core.sessions import Session, SessionStore
 
-from ui.keyboards import main_menu_kb, not_connected_kb
-from ui.texts import HELP_TEXT, _list_nav_kb, _list_page_text
+from ui.keyboards import REMOVE_KB, del_all_confirm_kb, main_menu_kb, not_connected_kb
+from ui.texts import HELP_TEXT, NEED_CONNECT, _list_nav_kb, _list_pages_text
 
 from utils.common import (
+    _chunks,
+    PAGE_SIZE,
     _gen_secret,
     _profile_key,
-    _slice_pairs,
     clean_url,
     equip_start,
+    is_target_token,
     next_free,
     parse_targets,
     _ext_to_slot
@@ -54,6 +59,8 @@ from utils.common import (
 
 log = logging.getLogger(__name__)
 
+_IPV4_RE = re.compile(r"^\d{1,3}(\.\d{1,3}){3}$")
+
 def _default_presets_path() -> str:
     env = os.getenv("PRESETS_PATH")
     if env:
@@ -78,7 +85,16 @@ def _default_presets_path() -> str:
 
 PRESETS_PATH = _default_presets_path()
 
-SESS: Dict[int, dict] = {}
+def _default_sessions_path() -> str:
+    env = os.getenv("SESSIONS_DB")
+    if env:
+        p = Path(env).expanduser()
+        p.parent.mkdir(parents=True, exist_ok=True)
+        return str(p)
+    return str(Path(PRESETS_PATH).parent / "sessions.sqlite3")
+
+# Сессии FreePBX переживают рестарт и общие для процессов с одной базой
+SESS = SessionStore(_default_sessions_path())
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
 GOIP_SESS: Dict[int, dict] = {}
 GOIP_STATE_CACHE: Dict[int, str] = {}
@@ -121,17 +137,98 @@ def fb_from_session(chat_id: int) -> FreePBX:
     s = SESS.get(chat_id)
     if not s:
         raise RuntimeError("Сначала /connect <ip> <login> <password>")
-    fb = FreePBX(s["base_url"], s["client_id"], s["client_secret"], verify=s["verify"])
-    fb.token = s.get("token")
-    fb.token_exp = s.get("token_exp", 0)
+    if isinstance(s.fb, FreePBX):
+        return s.fb
+    fb = FreePBX(s.base_url, s.client_id, s.client_secret, verify=s.verify)
+    fb.token = s.token
+    fb.token_exp = s.token_exp
+    fb.hints = s.schema_hints
+    _track_token(chat_id, fb)
+    # кэшируем на сессию: кэш gql, результаты интроспекции и подписка на токен живут
+    # между командами (HTTP-соединения и так общие на процесс)
+    s.fb = fb
     return fb
 
-def _need_connect_text() -> str:
-    return (
-        "❗️Сначала подключитесь:\n"
-        "<code>/connect &lt;host&gt; &lt;client_id&gt; &lt;client_secret&gt; [&lt;ssh_login&gt; &lt;ssh_password&gt;]</code>\n\n"
-        "…или откройте <b>Presets</b> ниже 👇"
-    )
+def _track_token(chat_id: int, fb: FreePBX) -> None:
+    """Новый токен и найденные формы запросов FreePBX сразу пишем в сессию — они переживут рестарт бота."""
+    def _save(token: str, token_exp: float) -> None:
+        s = SESS.get(chat_id)
+        if s is not None and s.fb is fb:
+            s.token, s.token_exp = token, token_exp
+            SESS.save(chat_id)
+
+    def _save_hints() -> None:
+        s = SESS.get(chat_id)
+        if s is not None and s.fb is fb:
+            SESS.save(chat_id)  # fb.hints — тот же словарь, что s.schema_hints
+
+    fb.on_token = _save
+    fb.on_hints = _save_hints
+
+async def _render_list(chat_id: int, fb: FreePBX, page: int = 0, fresh: bool = False):
+    """
+    Текст страницы /list и клавиатура навигации. Страницы собираются целиком
+    один раз и живут в сессии GQL_CACHE_TTL секунд — листание не пересобирает текст.
+    """
+    s = SESS.get(chat_id)
+    cached = s.list_pages if s else None
+    if fresh or not cached or time.monotonic() - cached[0] >= GQL_CACHE_TTL:
+        pairs = await fb.fetch_all_extensions()
+        pages = _list_pages_text(clean_url(fb.base_url), pairs, PAGE_SIZE)
+        if s:
+            s.list_pages = (time.monotonic(), pages)
+    else:
+        pages = cached[1]
+    page = max(0, min(page, len(pages) - 1))
+    return pages[page], _list_nav_kb(page, len(pages))
+
+async def _introspect_quietly(fb: FreePBX) -> None:
+    # интроспекция может быть выключена на сервере — тогда остаются запросы с фоллбеком
+    try:
+        await fb.introspect()
+    except Exception as e:
+        log.info(f"GraphQL introspection unavailable: {e}")
+
+# chat_id -> [замок, сколько корутин его держат или ждут]
+_SESS_LOCKS: Dict[int, list] = {}
+
+@asynccontextmanager
+async def _sess_lock(chat_id: int):
+    """
+    Один замок на чат: connect/reconnect/logout не перетирают сессию друг другу.
+    Запись живёт, пока замок кто-то держит или ждёт, — после /logout и вообще
+    в простое словарь не растёт.
+    """
+    entry = _SESS_LOCKS.get(chat_id)
+    if entry is None:
+        entry = _SESS_LOCKS[chat_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1] and _SESS_LOCKS.get(chat_id) is entry:
+            del _SESS_LOCKS[chat_id]
+
+async def _replace_session(chat_id: int, sess: "Session | None") -> None:
+    """
+    Подменяет сессию чата (None — удалить) и только потом закрывает старый клиент,
+    чтобы параллельный хэндлер не успел взять уже закрытый FreePBX.
+    """
+    async with _sess_lock(chat_id):
+        old = getattr(SESS.get(chat_id), "fb", None)
+        if sess is None:
+            SESS.pop(chat_id, None)
+        else:
+            SESS[chat_id] = sess
+            if isinstance(sess.fb, FreePBX):
+                _track_token(chat_id, sess.fb)
+        if isinstance(old, FreePBX) and old is not getattr(sess, "fb", None):
+            try:
+                await old.aclose()
+            except Exception:
+                pass
 
 async def _ensure_connected(u: Update) -> bool:
     chat = u.effective_chat
@@ -139,7 +236,7 @@ async def _ensure_connected(u: Update) -> bool:
         return True
 
     # Показываем текст + кнопку "Presets"
-    text = _need_connect_text()
+    text = NEED_CONNECT
     kb = not_connected_kb(True)  # рисуем кнопку Presets даже если список пуст — внутри меню это обработается
 
     # Унифицированный ответ: если это обычное сообщение — reply_text, если callback — alert + редактирование не трогаем
@@ -158,11 +255,155 @@ async def _ensure_connected(u: Update) -> bool:
             pass
     return False
 
+async def _run_bounded(coros, limit: int = 8):
+    """asyncio.gather с ограничением числа одновременных запросов к FreePBX."""
+    sem = asyncio.Semaphore(limit)
+
+    async def _w(coro):
+        async with sem:
+            return await coro
+
+    return await asyncio.gather(*(_w(x) for x in coros), return_exceptions=True)
+
+# Отдельный пул под блокирующие вызовы (paramiko, requests к GoIP), чтобы цикл событий
+# и getUpdates не вставали на многосекундных SSH-командах
+_EXECUTOR = ThreadPoolExecutor(max_workers=16, thread_name_prefix="blocking")
+
+async def _run_blocking(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+async def _edit_quietly(edit, text: str, **kwargs) -> None:
+    """edit_text для прогресса: «message is not modified» и прочее глотаем, на 429 ждём retry_after."""
+    try:
+        await edit(text, **kwargs)
+    except RetryAfter as e:
+        await asyncio.sleep(e.retry_after)
+    except Exception:
+        pass
+
+def _apply_in_background(c: ContextTypes.DEFAULT_TYPE, fb: FreePBX, edit, done_text: str = "✅ Конфиг применён."):
+    """
+    Ставит отложенный Apply Config (серия команд подряд — один reload) и не держит
+    хэндлер: когда reload завершится, сообщение будет отредактировано через edit.
+    """
+    fut = fb.schedule_apply()
+
+    async def _report():
+        try:
+            await fut
+        except Exception as e:
+            await _edit_quietly(edit, f"⚠️ Apply Config не удалось: <code>{escape(str(e))}</code>")
+        else:
+            await _edit_quietly(edit, done_text)
+
+    c.application.create_task(_report())
+
+def _progress_editor(edit, min_interval: float = 1.0):
+    """
+    Обёртка над edit для прогресса: не чаще раза в min_interval сек и без
+    повторов того же текста; force=True (финальное значение) проходит всегда.
+    """
+    last = {"t": 0.0, "text": None}
+
+    async def _update(text: str, force: bool = False) -> None:
+        now = time.monotonic()
+        if text == last["text"] or (not force and now - last["t"] < min_interval):
+            return
+        last["t"], last["text"] = now, text
+        await _edit_quietly(edit, text)
+
+    return _update
+
+async def _poll_progress(counter: dict, on_progress, interval: float = 2.0):
+    """Фоновый опрос общего счётчика: прогресс рисуется не чаще раза в interval."""
+    last = -1
+    while True:
+        await asyncio.sleep(interval)
+        if counter["done"] != last:
+            last = counter["done"]
+            await on_progress(last)
+
+async def _run_batches(batches, worker, on_progress=None):
+    """
+    Прогоняет пачки через worker(batch) -> (ok, failed) параллельно (до 8 в полёте)
+    и склеивает результаты в исходном порядке.
+    """
+    counter = {"done": 0}
+
+    async def _one(batch):
+        try:
+            return await worker(batch)
+        finally:
+            counter["done"] += len(batch)
+
+    poller = asyncio.create_task(_poll_progress(counter, on_progress)) if on_progress else None
+    try:
+        results = await _run_bounded([_one(b) for b in batches])
+    finally:
+        if poller:
+            poller.cancel()
+    if on_progress:
+        await on_progress(counter["done"])
+
+    ok, failed = [], []
+    for res in results:
+        if isinstance(res, BaseException):
+            raise res
+        ok += res[0]
+        failed += res[1]
+    return ok, failed
+
+async def _create_exts_batched(fb: FreePBX, specs, on_progress=None):
+    """
+    Создаёт EXT пачками (один GraphQL-документ на пачку) и задаёт им пароли.
+    specs = [(ext, name), …]. Возвращает (created, failed).
+    """
+    async def _worker(batch):
+        created, failed = [], []
+        try:
+            res = await fb.create_many([(int(ext), name) for ext, name in batch])
+        except Exception as e:
+            return [], [f"{ext} ({str(e)[:60]})" for ext, _ in batch]
+        made = []
+        for ext, _ in batch:
+            err = res.get(str(ext))
+            if err is None:
+                made.append(str(ext))
+            else:
+                failed.append(f"{ext} ({err[:60]})")
+        if made:
+            try:
+                pw = await fb.set_passwords_many([(ext, secrets.token_hex(16)) for ext in made])
+            except Exception as e:
+                pw = {ext: str(e) for ext in made}
+            for ext in made:
+                if pw.get(ext) is None:
+                    created.append(ext)
+                else:
+                    failed.append(f"{ext} (пароль: {pw[ext][:60]})")
+        return created, failed
+
+    return await _run_batches(list(_chunks(list(specs), GQL_BATCH_SIZE)), _worker, on_progress)
+
+async def _delete_exts_batched(fb: FreePBX, exts, on_progress=None):
+    """Удаляет EXT пачками (один GraphQL-документ на пачку). Возвращает (ok, failed)."""
+    async def _worker(batch):
+        try:
+            res = await fb.delete_many(batch)
+        except Exception as e:
+            res = {ext: str(e) for ext in batch}
+        return (
+            [ext for ext in batch if res.get(ext) is None],
+            [ext for ext in batch if res.get(ext) is not None],
+        )
+
+    return await _run_batches(list(_chunks([str(x) for x in exts], GQL_BATCH_SIZE)), _worker, on_progress)
+
 async def start_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     await u.message.reply_text(
         "👋 Привет! Я помогу управлять FreePBX: подключение, список SIP, создание и удаление.\n"
         "Набери /help для инструкции.",
-        reply_markup=ReplyKeyboardRemove()
+        reply_markup=REMOVE_KB
     )
     await u.message.reply_text(
         "🏠 <b>Главное меню</b>",
@@ -203,26 +444,29 @@ async def connect_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
     try:
         # авторизация
-        fb.ensure_token()
+        await fb.ensure_token()
+        await _introspect_quietly(fb)
 
         # собираем сессию
-        sess = {
-            "base_url": fb.base_url,
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "verify": verify,
-            "token": fb.token,
-            "token_exp": fb.token_exp,
-        }
+        sess = Session(
+            base_url=fb.base_url,
+            client_id=client_id,
+            client_secret=client_secret,
+            verify=verify,
+            token=fb.token,
+            token_exp=fb.token_exp,
+            schema_hints=fb.hints,
+            fb=fb,
+        )
         if ssh_login and ssh_password:
-            sess["ssh"] = {
+            sess.ssh = {
                 "host": host_for_ssh,
                 "user": ssh_login,
                 "password": ssh_password,
                 "port": 22,
             }
 
-        SESS[u.effective_chat.id] = sess
+        await _replace_session(u.effective_chat.id, sess)
         c.user_data["__connected"] = True
 
         user_id = _uid(u)
@@ -235,23 +479,19 @@ async def connect_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
                 "client_id": client_id,
                 "client_secret": client_secret,
                 "verify": verify,
-                "ssh": sess.get("ssh"),
+                "ssh": sess.ssh,
                 "label": f"{host_for_ssh} • {client_id[:6]}…",
             }
             save_profiles_for(user_id, profiles)
 
 
-        pairs = fb.fetch_all_extensions()
-        c.user_data["__last_pairs"] = pairs
-        pairs_page, page, pages = _slice_pairs(pairs, page=0)
-        text = _list_page_text(clean_url(fb.base_url), pairs_page)
-        kb = _list_nav_kb(page, pages)
+        text, kb = await _render_list(u.effective_chat.id, fb, fresh=True)
 
         # сообщения
         msg = [f"✅ Подключено к <code>{escape(fb.base_url)}</code>"]
-        if "ssh" in sess:
-            shown_user = escape(sess["ssh"]["user"])
-            shown_host = escape(sess["ssh"]["host"])
+        if sess.ssh:
+            shown_user = escape(sess.ssh["user"])
+            shown_host = escape(sess.ssh["host"])
             msg.append(f"🔐 SSH сохранён: <code>{shown_user}@{shown_host}</code>")
         if is_new_profile:
             msg.append("💾 Профиль подключений сохранён в разделе меню <b>🔗 Presets</b>.")
@@ -267,6 +507,11 @@ async def connect_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         await u.message.reply_text(text, reply_markup=kb)
 
     except Exception as e:
+        if getattr(SESS.get(u.effective_chat.id), "fb", None) is not fb:
+            await fb.aclose()
+        if isinstance(e, FreePBXAuthError):
+            await u.message.reply_text("❌ FreePBX отклонил Client ID/Secret — проверьте данные API-приложения.")
+            return
         await u.message.reply_text(f"Ошибка подключения: <code>{escape(str(e))}</code>")
 
 async def connect_profile_by_key(u: Update, c: ContextTypes.DEFAULT_TYPE, key: str):
@@ -293,40 +538,44 @@ async def connect_profile_by_key(u: Update, c: ContextTypes.DEFAULT_TYPE, key: s
     await u.effective_message.chat.send_action(ChatAction.TYPING)
     fb = FreePBX(base_url, client_id, client_secret, verify=verify)
     try:
-        fb.ensure_token()
-        sess = {
-            "base_url": fb.base_url,
-            "client_id": client_id,
-            "client_secret": client_secret,
-            "verify": verify,
-            "token": fb.token,
-            "token_exp": fb.token_exp,
-        }
+        await fb.ensure_token()
+        await _introspect_quietly(fb)
+        sess = Session(
+            base_url=fb.base_url,
+            client_id=client_id,
+            client_secret=client_secret,
+            verify=verify,
+            token=fb.token,
+            token_exp=fb.token_exp,
+            schema_hints=fb.hints,
+            fb=fb,
+        )
         if ssh:
-            sess["ssh"] = {
+            sess.ssh = {
                 "host": ssh.get("host"),
                 "user": ssh.get("user"),
                 "password": ssh.get("password"),
                 "port": ssh.get("port", 22),
             }
-        SESS[u.effective_chat.id] = sess
+        await _replace_session(u.effective_chat.id, sess)
         c.user_data["__connected"] = True
 
-        pairs = fb.fetch_all_extensions()
-        c.user_data["__last_pairs"] = pairs
-        pairs_page, page, pages = _slice_pairs(pairs, page=0)
-        text = _list_page_text(clean_url(fb.base_url), pairs_page)
-        kb = _list_nav_kb(page, pages)
+        text, kb = await _render_list(u.effective_chat.id, fb, fresh=True)
 
         msgs = [f"✅ Подключено к <code>{escape(fb.base_url)}</code>"]
-        if "ssh" in sess:
-            shown_user = escape(sess["ssh"]["user"] or "—")
-            shown_host = escape(sess["ssh"]["host"] or "—")
+        if sess.ssh:
+            shown_user = escape(sess.ssh["user"] or "—")
+            shown_host = escape(sess.ssh["host"] or "—")
             msgs.append(f"🔐 SSH: <code>{shown_user}@{shown_host}</code>")
         await u.effective_message.reply_text("\n".join(msgs), parse_mode=ParseMode.HTML)
         await u.effective_message.reply_text("🏠 <b>Главное меню</b>", parse_mode=ParseMode.HTML, reply_markup=main_menu_kb())
         await u.effective_message.reply_text(text, reply_markup=kb)
     except Exception as e:
+        if getattr(SESS.get(u.effective_chat.id), "fb", None) is not fb:
+            await fb.aclose()
+        if isinstance(e, FreePBXAuthError):
+            await u.effective_message.reply_text("❌ FreePBX отклонил Client ID/Secret — проверьте данные API-приложения.")
+            return
         await u.effective_message.reply_text(f"Ошибка подключения: <code>{escape(str(e))}</code>")
 
 async def list_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
@@ -334,15 +583,10 @@ async def list_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     try:
         fb = fb_from_session(u.effective_chat.id)
-        pairs = fb.fetch_all_extensions()
-        c.user_data["__last_pairs"] = pairs
-        pairs_page, page, pages = _slice_pairs(pairs, page=0)
+        text, kb = await _render_list(u.effective_chat.id, fb, fresh=True)
 
         target = u.effective_message  # универсальная цель ответа
-        await target.reply_text(
-            _list_page_text(clean_url(fb.base_url), pairs_page),
-            reply_markup=_list_nav_kb(page, pages)
-        )
+        await target.reply_text(text, reply_markup=kb)
     except Exception as e:
         target = u.effective_message
         await target.reply_text(f"Ошибка: <code>{escape(str(e))}</code>")
@@ -381,47 +625,23 @@ async def create_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         notice = await target.reply_text(f"⏳ Создаю {cnt} линий… (0/{cnt})")
         await target.chat.send_action(ChatAction.TYPING)
 
-        all_pairs = fb.fetch_all_extensions()
-        existing = [ext for ext, _ in all_pairs]
+        by_ext, _, _ = await fb.fetch_ext_index()
         start = equip_start(eq)
-        targets = next_free(existing, start, cnt)
-
-        created = 0
-        for i, ext in enumerate(targets, 1):
-            fb.create_one(int(ext))
-            secret = secrets.token_hex(16)
-            fb.set_ext_password(ext, secret)
-
-            created += 1
-            if created % 5 == 0 or created == cnt:
-                try:
-                    await notice.edit_text(f"⏳ Создаю {cnt} линий… ({created}/{cnt})")
-                except Exception:
-                    pass
-            await asyncio.sleep(0)
-
-        if targets:
-            try:
-                try:
-                    await notice.edit_text("🔄 Применяю конфиг (Apply Config)…")
-                except Exception:
-                    pass
-                fb.apply_config()
-                try:
-                    await notice.edit_text("✅ Конфиг применён. Обновляю список…")
-                except Exception:
-                    pass
-            except Exception as e:
-                await target.reply_text(f"⚠️ Apply Config не удалось: <code>{escape(str(e))}</code>")
+        targets = next_free(by_ext.keys(), start, cnt)
 
-        pairs = fb.fetch_all_extensions()
-        c.user_data["__last_pairs"] = pairs
-        pairs_page, page, pages = _slice_pairs(pairs, page=0)
+        async def _progress(done):
+            await _edit_quietly(notice.edit_text, f"⏳ Создаю {cnt} линий… ({done}/{cnt})")
 
-        await target.reply_text(
-            _list_page_text(clean_url(fb.base_url), pairs_page),
-            reply_markup=_list_nav_kb(page, pages)
-        )
+        created, failed = await _create_exts_batched(fb, [(ext, None) for ext in targets], _progress)
+        if failed:
+            await target.reply_text("❌ Ошибка создания: " + ", ".join(failed))
+
+        if created:
+            await _edit_quietly(notice.edit_text, "🔄 Apply Config запланирован…")
+            _apply_in_background(c, fb, notice.edit_text)
+
+        text, kb = await _render_list(u.effective_chat.id, fb, fresh=True)
+        await target.reply_text(text, reply_markup=kb)
     except Exception as e:
         await target.reply_text(f"Ошибка создания: <code>{escape(str(e))}</code>")
 
@@ -437,28 +657,21 @@ async def del_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     requested = parse_targets(" ".join(c.args))
     try:
         await target.chat.send_action(ChatAction.TYPING)
-        by_ext, _, _ = fb.fetch_ext_index()
-        existing = set(by_ext.keys())
+        by_ext, _, _ = await fb.fetch_ext_index()
 
-        targets = [x for x in requested if x in existing]
-        missing = [x for x in requested if x not in existing]
+        # один проход; проверка прямо по ключам индекса, без копии во множество
+        targets, missing = [], []
+        for x in requested:
+            (targets if x in by_ext else missing).append(x)
 
         total = len(targets)
         notice = await target.reply_text(f"⏳ Удаляю линии… (0/{total})") if total else None
 
-        ok, failed = [], []
-        for i, ext in enumerate(targets, 1):
-            try:
-                fb.delete_extension(ext)
-                ok.append(ext)
-            except Exception:
-                failed.append(ext)
-            if notice and (i % 10 == 0 or i == total):
-                try:
-                    await notice.edit_text(f"⏳ Удаляю линии… ({i}/{total})")
-                except Exception:
-                    pass
-            await asyncio.sleep(0)
+        async def _progress(done):
+            if notice:
+                await _edit_quietly(notice.edit_text, f"⏳ Удаляю линии… ({done}/{total})")
+
+        ok, failed = await _delete_exts_batched(fb, targets, _progress)
 
         parts = []
         if ok:      parts.append("🗑️ Удалено: " + ", ".join(ok))
@@ -467,25 +680,12 @@ async def del_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         if not parts: parts.append("Нечего удалять.")
         await target.reply_text("\n".join(parts))
 
-        if ok:
-            try:
-                if notice:
-                    try: await notice.edit_text("🔄 Применяю конфиг (Apply Config)…")
-                    except Exception: pass
-                fb.apply_config()
-                if notice:
-                    try: await notice.edit_text("✅ Конфиг применён. Обновляю список…")
-                    except Exception: pass
-            except Exception as e:
-                await target.reply_text(f"⚠️ Apply Config не удалось: <code>{escape(str(e))}</code>")
+        if ok and notice:
+            await _edit_quietly(notice.edit_text, "🔄 Apply Config запланирован…")
+            _apply_in_background(c, fb, notice.edit_text)
 
-        pairs = fb.fetch_all_extensions()
-        c.user_data["__last_pairs"] = pairs
-        page_items, page, pages = _slice_pairs(pairs, page=0)
-        await target.reply_text(
-            _list_page_text(clean_url(fb.base_url), page_items),
-            reply_markup=_list_nav_kb(page, pages)
-        )
+        text, kb = await _render_list(u.effective_chat.id, fb, fresh=True)
+        await target.reply_text(text, reply_markup=kb)
     except Exception as e:
         await target.reply_text(f"Ошибка удаления: <code>{escape(str(e))}</code>")
 
@@ -505,11 +705,7 @@ async def del_eq_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 async def del_all_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     if not await _ensure_connected(u):
         return
-    kb = InlineKeyboardMarkup([
-        [InlineKeyboardButton("Да, удалить всё", callback_data="delall:yes"),
-         InlineKeyboardButton("Отмена", callback_data="delall:no")]
-    ])
-    await u.message.reply_text("⚠️ Точно удалить все линии?", reply_markup=kb)
+    await u.message.reply_text("⚠️ Точно удалить все линии?", reply_markup=del_all_confirm_kb())
 
 async def add_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     if not c.args:
@@ -536,13 +732,12 @@ async def add_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         total = len(targets)
         notice = await u.message.reply_text(f"⏳ Добавляю линии… (0/{total})")
 
-        by_ext, name_set, name_ok = fb.fetch_ext_index()
+        by_ext, name_set, name_ok = await fb.fetch_ext_index()
         existing_exts = set(by_ext.keys())
 
-        created, skipped_ext, skipped_name = [], [], []
+        to_create, skipped_ext, skipped_name = [], [], []
         name_check_warn = False
 
-        processed = 0
         for raw in targets:
             ext = str(int(raw))
             cand_name = (f"{name_tail} {ext}" if "-" in arg0 else name_tail) if name_tail else ext
@@ -554,25 +749,23 @@ async def add_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             else:
                 if not name_ok:
                     name_check_warn = True
-                fb.create_one(int(ext), cand_name)
-                secret = secrets.token_hex(16)
-                fb.set_ext_password(ext, secret)
-                created.append(ext)
+                to_create.append((ext, cand_name))
                 existing_exts.add(ext)
                 if name_ok and cand_name.strip():
                     name_set.add(cand_name.strip().lower())
 
-            processed += 1
-            if processed % 5 == 0 or processed == total:
-                try:
-                    await notice.edit_text(f"⏳ Добавляю линии… ({processed}/{total})")
-                except Exception:
-                    pass
-            await asyncio.sleep(0)
+        skipped = total - len(to_create)
+
+        async def _progress(done):
+            await _edit_quietly(notice.edit_text, f"⏳ Добавляю линии… ({skipped + done}/{total})")
+
+        created, failed = await _create_exts_batched(fb, to_create, _progress)
 
         parts = []
         if created:
             parts.append("✅ Создано: " + ", ".join(created))
+        if failed:
+            parts.append("❌ Ошибка создания: " + ", ".join(failed))
         if skipped_ext:
             parts.append("↩️ Уже существуют EXT: " + ", ".join(skipped_ext))
         if skipped_name:
@@ -584,26 +777,11 @@ async def add_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         await u.message.reply_text("\n".join(parts))
 
         if created:
-            try:
-                try:
-                    await notice.edit_text("🔄 Применяю конфиг (Apply Config)…")
-                except Exception:
-                    pass
-                fb.apply_config()
-                try:
-                    await notice.edit_text("✅ Конфиг применён. Обновляю список…")
-                except Exception:
-                    pass
-            except Exception as e:
-                await u.message.reply_text(f"⚠️ Apply Config не удалось: <code>{escape(str(e))}</code>")
+            await _edit_quietly(notice.edit_text, "🔄 Apply Config запланирован…")
+            _apply_in_background(c, fb, notice.edit_text)
 
-        pairs = fb.fetch_all_extensions()
-        c.user_data["__last_pairs"] = pairs
-        page_items, page, pages = _slice_pairs(pairs, page=0)
-        await u.message.reply_text(
-            _list_page_text(clean_url(fb.base_url), page_items),
-            reply_markup=_list_nav_kb(page, pages)
-        )
+        text, kb = await _render_list(u.effective_chat.id, fb, fresh=True)
+        await u.message.reply_text(text, reply_markup=kb)
     except Exception as e:
         await u.message.reply_text(f"Ошибка /add: <code>{escape(str(e))}</code>")
 
@@ -612,11 +790,14 @@ async def reconnect_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     try:
         target = u.effective_message
-        s = SESS.get(u.effective_chat.id)
-        fb = FreePBX(s["base_url"], s["client_id"], s["client_secret"], verify=s["verify"])
-        fb.ensure_token()
-        s["token"] = fb.token
-        s["token_exp"] = fb.token_exp
+        async with _sess_lock(u.effective_chat.id):
+            # тот же объект FreePBX: схема, подсказки и отложенный Apply сохраняются,
+            # меняется только токен (пул соединений общий на процесс)
+            fb = fb_from_session(u.effective_chat.id)
+            await fb.aclose()
+            fb.token = None
+            fb.invalidate_cache()
+            await fb.ensure_token()  # новый токен попадёт в сессию через on_token
         await target.reply_text("🔁 Переподключение выполнено.")
     except Exception as e:
         await target.reply_text(f"Ошибка reconnect: <code>{escape(str(e))}</code>")
@@ -627,9 +808,11 @@ async def ping_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     try:
         target = u.effective_message
         fb = fb_from_session(u.effective_chat.id)
-        fb.ensure_token()
-        _ = fb.gql("query { fetchAllExtensions { extension { extensionId } } }")
+        # токен берётся/обновляется внутри gql только при необходимости
+        _ = await fb.gql("query { fetchAllExtensions { extension { extensionId } } }", use_cache=False)
         await target.reply_text("✅ OK")
+    except FreePBXAuthError as e:
+        await target.reply_text(f"❌ Unauthorized: <code>{escape(str(e))}</code>\nПроверьте Client ID/Secret или выполните /reconnect.")
     except Exception as e:
         await target.reply_text(f"❌ Unauthorized / ошибка: <code>{escape(str(e))}</code>")
 
@@ -638,14 +821,15 @@ async def whoami_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     target = u.effective_message
     s = SESS.get(u.effective_chat.id)
-    ttl = max(0, int(s.get("token_exp", 0) - time.time()))
-    token = s.get("token", "<нет токена>")
+    fb = fb_from_session(u.effective_chat.id)
+    ttl = max(0, int(fb.token_exp - time.time()))
+    token = fb.token or "<нет токена>"
 
     await target.reply_text(
         "👤 <b>Текущая сессия</b>\n"
-        f"URL: <code>{s['base_url']}</code>\n"
-        f"Client ID: <code>{s['client_id']}</code>\n"
-        f"TLS verify: <code>{s['verify']}</code>\n"
+        f"URL: <code>{s.base_url}</code>\n"
+        f"Client ID: <code>{s.client_id}</code>\n"
+        f"TLS verify: <code>{s.verify}</code>\n"
         f"Токен жив ещё: <code>{ttl} сек</code>\n"
         f"Access Token:\n<code>{token}</code>",
         parse_mode=ParseMode.HTML
@@ -653,7 +837,7 @@ async def whoami_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
 async def logout_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     target = u.effective_message
-    SESS.pop(u.effective_chat.id, None)
+    await _replace_session(u.effective_chat.id, None)
     c.user_data.clear()
     await target.reply_text("🚪 Сессия сброшена. Используйте /connect.")
 
@@ -663,7 +847,7 @@ async def list_routes_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     fb = fb_from_session(u.effective_chat.id)
     target = u.effective_message
     try:
-        routes = fb.list_inbound_routes()
+        routes = await fb.list_inbound_routes()
         if not routes:
             await target.reply_text("Маршрутов не найдено.")
             return
@@ -709,14 +893,12 @@ async def add_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     try:
         await target.chat.send_action(ChatAction.TYPING)
 
-        by_ext, _, _ = fb.fetch_ext_index()
-        existing_exts = set(by_ext.keys())
-
-        routes_now = fb.list_inbound_routes()
-        existing_dids = {r.get("extension") for r in routes_now if r.get("extension")}
+        by_ext, _, _ = await fb.fetch_ext_index()
+        existing_dids = await fb.inbound_route_index()
 
-        todo = [x for x in targets if x in existing_exts]
-        missing = [x for x in targets if x not in existing_exts]
+        todo, missing = [], []
+        for x in targets:
+            (todo if x in by_ext else missing).append(x)
 
         total = len(todo)
         if total == 0:
@@ -728,27 +910,34 @@ async def add_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
         notice = await target.reply_text(f"⏳ Добавляю Inbound Routes… (0/{total})")
 
-        ok, skipped_exists, failed = [], [], []
-        for i, ext in enumerate(todo, 1):
-            did_prefx = f"_sim{ext}"
-            if ext in existing_dids or did_prefx in existing_dids:
+        skipped_exists, failed = [], []
+        fresh = []
+        for ext in todo:
+            if ext in existing_dids or f"_sim{ext}" in existing_dids:
                 skipped_exists.append(ext)
             else:
-                try:
-                    fb.create_inbound_route(did=did_prefx, description=f"sim{ext}", ext=ext)
-                    ok.append(ext)
-                    existing_dids.add(did_prefx)
-                except AlreadyExists:
-                    skipped_exists.append(ext)
-                except Exception as e:
-                    failed.append(f"{ext} ({str(e)[:80]})")
-
-            if i % 5 == 0 or i == total:
-                try:
-                    await notice.edit_text(f"⏳ Добавляю Inbound Routes… ({i}/{total})")
-                except Exception:
-                    pass
-            await asyncio.sleep(0)
+                fresh.append(ext)
+
+        # маршруты независимы друг от друга — создаём параллельно (до 8 в полёте)
+        async def _one(batch):
+            ext = batch[0]
+            try:
+                await fb.create_inbound_route(did=f"_sim{ext}", description=f"sim{ext}", ext=ext)
+            except AlreadyExists:
+                return [], [(ext, None)]
+            except Exception as e:
+                return [], [(ext, f"{ext} ({str(e)[:80]})")]
+            return [ext], []
+
+        async def _progress(done):
+            await _edit_quietly(notice.edit_text, f"⏳ Добавляю Inbound Routes… ({len(skipped_exists) + done}/{total})")
+
+        ok, errs = await _run_batches([[ext] for ext in fresh], _one, _progress)
+        for ext, err in errs:
+            if err:
+                failed.append(err)
+            else:
+                skipped_exists.append(ext)
 
         parts = []
         if ok:
@@ -762,28 +951,20 @@ async def add_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         await target.reply_text("\n".join(parts) if parts else "Нечего делать.")
 
         if ok:
-            try:
-                try:
-                    await notice.edit_text("🔄 Применяю конфиг (Apply Config)…")
-                except Exception:
-                    pass
-                fb.apply_config()
-                try:
-                    await notice.edit_text("✅ Конфиг применён.")
-                except Exception:
-                    pass
-            except Exception as e:
-                await target.reply_text(f"⚠️ Apply Config не удалось: <code>{escape(str(e))}</code>")
+            await _edit_quietly(notice.edit_text, "🔄 Apply Config запланирован…")
+            _apply_in_background(c, fb, notice.edit_text)
 
             try:
                 goip = goip_from_session(u.effective_chat.id)
                 slots = sorted({ext_to_slot(x) for x in ok if ext_to_slot(x)})
                 if slots:
                     done, errs = [], []
+                    # GoIP-клиент синхронный — уводим в поток, чтобы не стопорить цикл событий;
+                    # все слоты — одним сохранением формы
+                    res = await _run_blocking(goip.set_incoming_enabled_many, slots, True)
                     for s in slots:
-                        ok1, msg1 = goip.set_incoming_enabled(s, True)
+                        ok1, msg1 = res[s]
                         (done if ok1 else errs).append(str(s) if ok1 else f"{s} ({msg1})")
-                        await asyncio.sleep(0)
                     lines = []
                     if done: lines.append("📲 GOIP: включены входящие для слотов: " + ", ".join(done))
                     if errs: lines.append("⚠️ GOIP: ошибки по слотам: " + ", ".join(errs))
@@ -821,8 +1002,7 @@ async def del_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             await target.reply_text("❗ Не удалось распарсить цели. Пример: <code>/del_inbound 401 402 410-418</code>", parse_mode=ParseMode.HTML)
             return
 
-        routes = fb.list_inbound_routes()
-        route_by_did = { (r.get("extension") or "").strip(): r for r in routes if r.get("extension") }
+        route_by_did = await fb.inbound_route_index()
 
         todo, missing = [], []
         for ext in exts:
@@ -844,10 +1024,11 @@ async def del_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         total = len(todo)
         notice = await target.reply_text(f"⏳ Удаляю Inbound Routes… (0/{total})")
 
+        progress = _progress_editor(notice.edit_text)
         ok, failed = [], []
         for i, (shown, route, ext) in enumerate(todo, 1):
             try:
-                res = fb.delete_inbound_route(route["id"])
+                res = await fb.delete_inbound_route(route["id"])
                 status = (res.get("status") if isinstance(res, dict) else None)
                 msg = (res.get("message") if isinstance(res, dict) else "") or ""
                 status_str = str(status).lower() if status is not None else ""
@@ -856,28 +1037,10 @@ async def del_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             except Exception as e:
                 failed.append((shown, ext, str(e)))
 
-            if i % 5 == 0 or i == total:
-                try:
-                    await notice.edit_text(f"⏳ Удаляю Inbound Routes… ({i}/{total})")
-                except Exception:
-                    pass
-            await asyncio.sleep(0)
+            await progress(f"⏳ Удаляю Inbound Routes… ({i}/{total})", force=i == total)
 
-        try:
-            await notice.edit_text("🔄 Применяю конфиг (Apply Config)…")
-        except Exception:
-            pass
-        try:
-            fb.apply_config()
-            try:
-                await notice.edit_text("✅ Конфиг применён. Формирую отчёт…")
-            except Exception:
-                pass
-        except Exception as e:
-            try:
-                await notice.edit_text(f"⚠️ Apply Config не удалось: {escape(str(e))}")
-            except Exception:
-                pass
+        await _edit_quietly(notice.edit_text, "🔄 Apply Config запланирован…")
+        _apply_in_background(c, fb, notice.edit_text)
 
         try:
             if ok:
@@ -887,10 +1050,10 @@ async def del_inbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
                 slots = sorted({ _ext_to_slot(ext) for _, ext, _ in ok if _ext_to_slot(ext) })
                 if slots:
                     done, errs = [], []
+                    res = await _run_blocking(goip.set_incoming_enabled_many, slots, False)
                     for s in slots:
-                        ok1, msg1 = goip.set_incoming_enabled(s, False)
+                        ok1, msg1 = res[s]
                         (done if ok1 else errs).append(str(s) if ok1 else f"{s} ({msg1})")
-                        await asyncio.sleep(0)
                     if done:
                         await target.reply_text("📲 GOIP: выключены входящие для слотов: " + ", ".join(done))
                     if errs:
@@ -919,7 +1082,7 @@ async def gql_fields_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     fb = fb_from_session(u.effective_chat.id)
     target = u.effective_message
     try:
-        fields = fb.list_query_fields()
+        fields = await fb.list_query_fields()
         if not fields:
             await target.reply_text("Query-поля не найдены.")
             return
@@ -943,7 +1106,7 @@ async def gql_mutations_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     fb = fb_from_session(u.effective_chat.id)
     target = u.effective_message
     try:
-        muts = fb.list_mutations()
+        muts = await fb.list_mutations()
         if not muts:
             await target.reply_text("Mutation-поля не найдены.")
             return
@@ -986,11 +1149,6 @@ def goip_from_session(chat_id: int) -> GoIP:
             s["_obj"] = obj  # кэшируем
             return obj
 
-    s2 = SESS.get(chat_id) or {}
-    obj2 = s2.get("goip") or s2.get("GOIP")
-    if isinstance(obj2, GoIP):
-        return obj2
-
     raise RuntimeError("GOIP не подключен. Сначала /goip_connect <url> <login> <password>")
 
 async def goip_connect_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
@@ -1028,15 +1186,27 @@ async def goip_connect_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     verify = not raw_url.startswith("http://")
 
     try:
+        goip = GoIP(raw_url, login, password, verify=verify)
+        radmin = None
         if radmin_args and len(radmin_args) >= 3:
+            # разогрев Радмина и первая проверка GoIP идут параллельно: ждём max, а не сумму
             rurl, rlogin, rpass = radmin_args[0], radmin_args[1], " ".join(radmin_args[2:])
-            ok, info = GoIP.warmup_radmin(rurl, rlogin, rpass, verify=not rurl.startswith("http://"))
-            await target.reply_text(("✅ " if ok else "⚠️ ") + f"Radmin warmup: {escape(info)}")
-
-        goip = GoIP(raw_url, login, password, verify=verify)
-        state, msg, code = goip.check_status()
+            radmin = asyncio.ensure_future(
+                _run_blocking(GoIP.warmup_radmin, rurl, rlogin, rpass, verify=not rurl.startswith("http://"))
+            )
 
-        # сохраняем сессию
+        state, msg, code = await _run_blocking(goip.check_status)
+        if radmin is not None:
+            ok, info = await radmin
+            await target.reply_text(("✅ " if ok else "⚠️ ") + f"Radmin warmup: {escape(info)}")
+            if ok and state != GoipStatus.READY:
+                # GoIP могла не пускать, пока Радмин не увидел наш IP — проверяем ещё раз
+                state, msg, code = await _run_blocking(goip.check_status)
+
+        # сохраняем сессию; у прежней GoIP закрываем её keep-alive соединения
+        old = GOIP_SESS.get(u.effective_chat.id, {}).get("_obj")
+        if isinstance(old, GoIP) and old is not goip:
+            old.close()
         GOIP_SESS[u.effective_chat.id] = {
             "base_url": goip.base_url,
             "login": login,
@@ -1072,7 +1242,7 @@ async def goip_ping_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     target = u.effective_message
     try:
         goip = goip_from_session(u.effective_chat.id)
-        state, msg, code = goip.check_status()
+        state, msg, code = await _run_blocking(goip.check_status)
         prefix = "✅" if state == GoipStatus.READY else ("❌" if state == GoipStatus.UNAUTHORIZED else "⚠️")
         await target.reply_text(f"{prefix} {msg} (HTTP {code or '—'})\nURL: <code>{goip.status_url}</code>")
     except Exception as e:
@@ -1097,8 +1267,8 @@ async def _goip_periodic_check(context: ContextTypes.DEFAULT_TYPE):
     if not s:
         return
 
-    goip = GoIP(s["base_url"], s["login"], s["password"], verify=s["verify"])
-    state, msg, code = goip.check_status()
+    goip = goip_from_session(chat_id)  # тот же экземпляр — живое соединение переиспользуется
+    state, msg, code = await _run_blocking(goip.check_status)
 
     prev = GOIP_STATE_CACHE.get(chat_id)
     if state != prev:
@@ -1129,7 +1299,7 @@ async def goip_in_on_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     slot = int(c.args[0])
     goip = goip_from_session(u.effective_chat.id)
-    ok, msg = goip.set_incoming_enabled(slot, True)
+    ok, msg = await _run_blocking(goip.set_incoming_enabled, slot, True)
     await u.effective_message.reply_text(("✅ " if ok else "❌ ") + msg)
 
 async def goip_in_off_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
@@ -1138,12 +1308,12 @@ async def goip_in_off_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
     slot = int(c.args[0])
     goip = goip_from_session(u.effective_chat.id)
-    ok, msg = goip.set_incoming_enabled(slot, False)
+    ok, msg = await _run_blocking(goip.set_incoming_enabled, slot, False)
     await u.effective_message.reply_text(("✅ " if ok else "❌ ") + msg)
     
 async def goip_debug_config_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     goip = goip_from_session(u.effective_chat.id)
-    ok, msg = goip.fetch_config_page()
+    ok, msg = await _run_blocking(goip.fetch_config_page)
     if ok:
         await u.effective_message.reply_text(
             "✅ Удалось получить config.html:\n\n<pre>" + 
@@ -1163,8 +1333,8 @@ async def goip_detect_ip_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     target = u.effective_message
 
     # достаём SSH из сессии
-    s = SESS.get(u.effective_chat.id) or {}
-    ssh = s.get("ssh")
+    s = SESS.get(u.effective_chat.id)
+    ssh = s.ssh if s else None
     if not ssh:
         await target.reply_text(
             "❌ SSH-доступ не сохранён.\n"
@@ -1183,7 +1353,8 @@ async def goip_detect_ip_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     try:
         await target.chat.send_action(ChatAction.TYPING)
 
-        best_ip, ips = fetch_goip_ips_via_ssh(
+        best_ip, ips = await _run_blocking(
+            fetch_goip_ips_via_ssh,
             host=ssh_host,
             username=ssh_login,
             password=ssh_password,
@@ -1232,7 +1403,7 @@ async def pjsip_endpoints_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
     try:
         await target.chat.send_action(ChatAction.TYPING)
-        names = fetch_pjsip_endpoints_via_ssh(ssh_host, ssh_login, ssh_password)
+        names = await _run_blocking(fetch_pjsip_endpoints_via_ssh, ssh_host, ssh_login, ssh_password)
         if flt:
             names = [n for n in names if flt in n.lower()]
         if not names:
@@ -1278,7 +1449,7 @@ async def pjsip_show_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
     try:
         await target.chat.send_action(ChatAction.TYPING)
-        raw = fetch_endpoint_raw_via_ssh(ssh_host, ssh_login, ssh_password, endpoint)
+        raw = await _run_blocking(fetch_endpoint_raw_via_ssh, ssh_host, ssh_login, ssh_password, endpoint)
         # обрежем до 3500 символов и экранируем
         shown = raw[:3500].replace("<", "&lt;").replace(">", "&gt;")
         suffix = "" if len(raw) <= 3500 else "\n\n…(обрезано)"
@@ -1305,8 +1476,8 @@ async def set_incoming_sip_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     target = u.effective_message
 
     # 0) Проверим SSH в сессии
-    s = SESS.get(u.effective_chat.id) or {}
-    ssh = s.get("ssh")
+    s = SESS.get(u.effective_chat.id)
+    ssh = s.ssh if s else None
     if not ssh:
         await target.reply_text(
             "❌ SSH-доступ не сохранён. Подключитесь командой:\n"
@@ -1325,7 +1496,8 @@ async def set_incoming_sip_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         await target.chat.send_action(ChatAction.TYPING)
 
         # 1) Детект IP так же, как делает /goip_detect_ip
-        best_ip, ips = fetch_goip_ips_via_ssh(
+        best_ip, ips = await _run_blocking(
+            fetch_goip_ips_via_ssh,
             host=ssh_host,
             username=ssh_login,
             password=ssh_password,
@@ -1341,14 +1513,15 @@ async def set_incoming_sip_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             return
 
         # лёгкая валидация найденного IP
-        if not re.match(r"^\d{1,3}(\.\d{1,3}){3}$", best_ip):
+        if not _IPV4_RE.match(best_ip):
             await target.reply_text(
                 f"❌ Детектирован непохожий на IPv4 адрес: <code>{escape(best_ip)}</code>"
             )
             return
 
         # 2) Обновляем sip_server у goip32sell_incoming
-        report = set_incoming_trunk_sip_server_via_ssh(
+        report = await _run_blocking(
+            set_incoming_trunk_sip_server_via_ssh,
             host=ssh_host,
             username=ssh_login,
             password=ssh_password,
@@ -1405,7 +1578,7 @@ async def set_secret_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     target_tokens = []
     fixed_pass = None
     for tok in raw:
-        if re.fullmatch(r"\d+(-\d+)?", tok):
+        if is_target_token(tok):
             target_tokens.append(tok)
         else:
             fixed_pass = tok
@@ -1426,8 +1599,8 @@ async def set_secret_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         return
 
     # ---- SSH из сессии
-    s = SESS.get(u.effective_chat.id) or {}
-    ssh = s.get("ssh")
+    s = SESS.get(u.effective_chat.id)
+    ssh = s.ssh if s else None
     if not ssh:
         await target.reply_text(
             "❌ SSH-доступ не сохранён. Подключитесь:\n"
@@ -1438,50 +1611,41 @@ async def set_secret_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     ssh_host, ssh_user, ssh_pass = ssh.get("host"), ssh.get("user"), ssh.get("password")
 
     total = len(exts)
-    notice = await target.reply_text(f"⏳ Меняю пароли… (0/{total})")
+    notice = await target.reply_text(f"⏳ Меняю пароли ({total} EXT)…")
     try:
         await target.chat.send_action(ChatAction.TYPING)
 
-        # Один проход: пишем secret без reload; reload сделаем один раз в конце
-        reports = []   # для случая одного EXT — покажем подробный отчёт
-        ok, failed = [], []
-
-        async def _progress(i):
-            if i % 5 == 0 or i == total:
-                try:
-                    await notice.edit_text(f"⏳ Меняю пароли… ({i}/{total})")
-                except Exception:
-                    pass
+        # Все secret одним SQL-пакетом без reload; reload сделаем один раз в конце
+        pairs = [(ext, fixed_pass or _gen_secret()) for ext in exts]
+        reps = await _run_blocking(
+            set_extension_chansip_secrets_bulk_via_ssh,
+            host=ssh_host, username=ssh_user, password=ssh_pass,
+            pairs=pairs, do_reload=False,
+        )
+        reports = [(rep, rep["new_value"]) for rep in reps]  # для случая одного EXT — подробный отчёт
+        # SQL-пакет — всё или ничего: при сбое выше уже вылетел SSHExecError
+        ok = [rep["ext"] for rep in reps]
 
-        for i, ext in enumerate(exts, 1):
+        # опциональная синхронизация в GraphQL: {ext: текст ошибки} по тем, где не вышло
+        ext_errors: Dict[str, str] = {}
+        if also_ext:
             try:
-                pwd = fixed_pass or _gen_secret()
-                rep = set_extension_chansip_secret_via_ssh(
-                    host=ssh_host, username=ssh_user, password=ssh_pass,
-                    extension=ext, new_secret=pwd,
-                    do_reload=False  # важн.: единый reload в конце
-                )
-                reports.append((rep, pwd))
-                # опциональная синхронизация в GraphQL
-                if also_ext:
+                fb = fb_from_session(u.effective_chat.id)
+                for batch in _chunks(pairs, GQL_BATCH_SIZE):
                     try:
-                        fb = fb_from_session(u.effective_chat.id)
-                        fb.set_ext_password(ext, pwd)
-                    except Exception:
-                        pass
-                ok.append(ext)
+                        res = await fb.set_passwords_many(batch)
+                    except Exception as e:
+                        res = {ext: str(e) for ext, _ in batch}
+                    ext_errors.update({ext: err for ext, err in res.items() if err})
             except Exception as e:
-                failed.append(f"{ext} ({str(e)[:60]})")
-
-            await _progress(i)
-            await asyncio.sleep(0)
+                ext_errors = {ext: str(e) for ext, _ in pairs}
 
         # ЕДИНЫЙ reload
         try:
             await notice.edit_text("🔄 Применяю конфиг (Apply Config)…")
         except Exception:
             pass
-        _ssh_run(ssh_host, ssh_user, ssh_pass, "fwconsole reload", timeout=30)
+        await _run_blocking(reload_freepbx, ssh_host, ssh_user, ssh_pass)
 
         # Итог
         if total == 1 and reports:
@@ -1498,7 +1662,10 @@ async def set_secret_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             ]
             if rep.get("md5_present"):
                 lines.append("⚠️ Обнаружен <code>md5_cred</code>. Клиент/GUI могут использовать MD5 вместо обычного пароля.")
-            if also_ext:
+            if also_ext and ext_errors:
+                err = next(iter(ext_errors.values()))
+                lines.append(f"⚠️ <code>extPassword</code> (GraphQL) не обновлён: <code>{escape(err[:200])}</code>")
+            elif also_ext:
                 lines.append("🔁 Также обновлён <code>extPassword</code> пользователя (GraphQL).")
             await target.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
         else:
@@ -1510,12 +1677,15 @@ async def set_secret_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             parts = []
             if ok:
                 parts.append("✅ Обновлены: " + ", ".join(ok))
-            if failed:
-                parts.append("❌ Ошибки: " + ", ".join(failed))
             if not parts:
                 parts.append("Нечего делать.")
             if also_ext:
-                parts.append("ℹ️ Также синхронизирован <code>extPassword</code> для успешных EXT.")
+                synced = [ext for ext in ok if ext not in ext_errors]
+                if synced:
+                    parts.append(f"ℹ️ Также синхронизирован <code>extPassword</code> ({len(synced)} EXT).")
+                if ext_errors:
+                    parts.append("❌ <code>extPassword</code> не обновлён: " + ", ".join(
+                        f"{ext} ({escape(err[:80])})" for ext, err in ext_errors.items()))
             await target.reply_text("\n".join(parts), parse_mode=ParseMode.HTML)
 
     except SSHExecError as e:
@@ -1534,8 +1704,8 @@ async def set_secret_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 async def radmin_restart_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     target = u.effective_message
 
-    s = SESS.get(u.effective_chat.id) or {}
-    ssh = s.get("ssh")
+    s = SESS.get(u.effective_chat.id)
+    ssh = s.ssh if s else None
     if not ssh:
         await target.reply_text(
             "❌ SSH-доступ не сохранён. Подключитесь:\n"
@@ -1552,7 +1722,7 @@ async def radmin_restart_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
 
         stop_out = ""
         try:
-            stop_out = _ssh_run(host, user, pwd, "killall radmsrv || true", timeout=10)
+            stop_out = await _run_blocking(_ssh_run, host, user, pwd, "killall radmsrv || true", timeout=10)
         except Exception as e:
             stop_out = str(e)
 
@@ -1562,10 +1732,10 @@ async def radmin_restart_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             pass
 
         start_cmd = r"nohup /root/radmsrv/run_radmsrv >/dev/null 2>&1 & echo $!"
-        pid = _ssh_run(host, user, pwd, start_cmd, timeout=10).strip()
+        pid = (await _run_blocking(_ssh_run, host, user, pwd, start_cmd, timeout=10)).strip()
 
         await asyncio.sleep(1.0)
-        ps = _ssh_run(host, user, pwd, "pgrep -fa radmsrv | head -n 3", timeout=10).strip()
+        ps = (await _run_blocking(_ssh_run, host, user, pwd, "pgrep -fa radmsrv | head -n 3", timeout=10)).strip()
 
         txt = [
             "✅ <b>radmsrv перезапущен</b>",
@@ -1638,8 +1808,8 @@ async def add_outbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
             i += 1
 
     # SSH из сессии
-    s = SESS.get(u.effective_chat.id) or {}
-    ssh = s.get("ssh")
+    s = SESS.get(u.effective_chat.id)
+    ssh = s.ssh if s else None
     if not ssh:
         await target.reply_text(
             "❌ SSH-доступ не сохранён. Подключитесь:\n"
@@ -1651,7 +1821,8 @@ async def add_outbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
     notice = await target.reply_text("⏳ Создаю outbound route…")
     try:
         await target.chat.send_action(ChatAction.TYPING)
-        rep = create_outbound_route_with_ranges_via_ssh(
+        rep = await _run_blocking(
+            create_outbound_route_with_ranges_via_ssh,
             host=ssh_host,
             username=ssh_user,
             password=ssh_pass,
@@ -1680,6 +1851,10 @@ async def add_outbound_cmd(u: Update, c: ContextTypes.DEFAULT_TYPE):
         await target.reply_text(f"Ошибка: <code>{escape(str(e))}</code>", parse_mode=ParseMode.HTML)
 
 
+async def on_shutdown(app):
+    await aclose_shared_clients()
+
+
 async def on_startup(app):
     print("✅ Бот запущен и слушает обновления. Набери /help в Telegram для инструкции.")
     log.info("✅ Бот запущен и слушает обновления. Команда помощи: /help")
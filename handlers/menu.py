@@ -35,10 +35,10 @@ from ui.keyboards import (
     servers_menu_kb,
     preset_actions_kb,
     not_connected_kb,
-    
+    del_all_confirm_kb,
 )
 from ui.texts import NOT_CONNECTED
-from utils.common import equip_start
+from utils.common import equip_start, is_target_token
 
 
 # ===== helpers =====
@@ -396,10 +396,9 @@ async def menu_text_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
             also_ext = True
             parts.remove("--also-ext")
 
-        import re
         target_tokens, fixed_pass = [], None
         for tok in parts:
-            if re.fullmatch(r"\d+(-\d+)?", tok):
+            if is_target_token(tok):
                 target_tokens.append(tok)
             else:
                 fixed_pass = tok
@@ -685,12 +684,7 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from handlers.commands import del_eq_cmd  # локальный импорт
         await del_eq_cmd(update, context); return
     if route == "ext.del_all":
-        from telegram import InlineKeyboardMarkup, InlineKeyboardButton
-        kb = InlineKeyboardMarkup([
-            [InlineKeyboardButton("Да, удалить всё", callback_data="delall:yes"),
-             InlineKeyboardButton("Отмена",          callback_data="delall:no")]
-        ])
-        await _safe_edit(q, "⚠️ Точно удалить все линии?", parse_mode=ParseMode.HTML, reply_markup=kb); return
+        await _safe_edit(q, "⚠️ Точно удалить все линии?", parse_mode=ParseMode.HTML, reply_markup=del_all_confirm_kb()); return
     # ===== ПАРОЛЬ =====
     if route == "ext.secret":
         # делаем универсальный ввод: один или много/диапазоны
@@ -1,5 +1,5 @@
 import os
-from telegram.ext import Application, Defaults, CommandHandler, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import AIORateLimiter, Application, Defaults, CommandHandler, CallbackQueryHandler, MessageHandler, filters
 from telegram.constants import ParseMode
 from dotenv import load_dotenv
 from handlers.commands import list_routes_cmd
@@ -8,7 +8,7 @@ from handlers.menu import menu_router, menu_text_router
 from handlers.commands import (
     start_cmd, help_cmd, connect_cmd, list_cmd, create_cmd, del_cmd,
     del_eq_cmd, del_all_cmd, add_cmd, reconnect_cmd,
-    ping_cmd, whoami_cmd, logout_cmd, on_startup, gql_fields_cmd, gql_mutations_cmd,
+    ping_cmd, whoami_cmd, logout_cmd, on_startup, on_shutdown, gql_fields_cmd, gql_mutations_cmd,
     menu_cmd, add_inbound_cmd, del_inbound_cmd,
     goip_connect_cmd, goip_ping_cmd, goip_whoami_cmd, 
     goip_start_watch_cmd, goip_in_on_cmd, goip_in_off_cmd, goip_debug_config_cmd,
@@ -17,6 +17,13 @@ from handlers.commands import (
 )
 from handlers.callbacks import list_nav_cb, del_all_cb, noop_cb
 
+try:
+    # uvloop быстрее стандартного цикла на сокетах; на Windows его нет — остаёмся на asyncio
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 def _get_token() -> str:
     load_dotenv()
     token = os.getenv("TELEGRAM_TOKEN", "").strip()
@@ -30,7 +37,17 @@ def _get_token() -> str:
 def build_app():
     token = _get_token()
     defaults = Defaults(parse_mode=ParseMode.HTML)
-    app = Application.builder().token(token).defaults(defaults).post_init(on_startup).build()
+    # Общий лимит исходящих вызовов Bot API (~30/с у Telegram) + авто-повтор после 429
+    limiter = AIORateLimiter(overall_max_rate=28, overall_time_period=1, max_retries=2)
+    app = (
+        Application.builder()
+        .token(token)
+        .defaults(defaults)
+        .rate_limiter(limiter)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     app.add_handler(CommandHandler("start", start_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
@@ -1,8 +1,14 @@
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from functools import lru_cache
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 from typing import Dict
 
 MENU_PREFIX = "menu:"
 
+# Клавиатуры ниже не зависят от состояния (или зависят только от хешируемых
+# аргументов) и неизменяемы в PTB, поэтому собираем их один раз и переиспользуем.
+REMOVE_KB = ReplyKeyboardRemove()
+
+@lru_cache(maxsize=None)
 def main_menu_kb() -> InlineKeyboardMarkup:
     rows = [
         [
@@ -22,11 +28,13 @@ def main_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(rows)
 
 
+@lru_cache(maxsize=None)
 def back_home_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(
         [[InlineKeyboardButton("🔙 Назад", callback_data=f"{MENU_PREFIX}home")]]
     )
 
+@lru_cache(maxsize=None)
 def ext_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -44,6 +52,7 @@ def ext_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("⬅️ Назад",               callback_data=f"{MENU_PREFIX}home")],
     ])
 
+@lru_cache(maxsize=None)
 def in_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -57,6 +66,7 @@ def in_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("⬅️ Назад",            callback_data=f"{MENU_PREFIX}home")],
     ])
 
+@lru_cache(maxsize=None)
 def sys_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -70,6 +80,7 @@ def sys_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("🔙 Назад",         callback_data=f"{MENU_PREFIX}home")],
     ])
 
+@lru_cache(maxsize=None)
 def gql_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -79,6 +90,7 @@ def gql_menu_kb() -> InlineKeyboardMarkup:
         [InlineKeyboardButton("🔙 Назад",         callback_data=f"{MENU_PREFIX}home")],
     ])
 
+@lru_cache(maxsize=None)
 def ast_menu_kb() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -102,6 +114,7 @@ def servers_menu_kb(profiles: Dict[str, dict]) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton("🔙 Назад", callback_data=f"{MENU_PREFIX}home")])
     return InlineKeyboardMarkup(rows)
 
+@lru_cache(maxsize=256)
 def preset_actions_kb(key: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
@@ -113,10 +126,18 @@ def preset_actions_kb(key: str) -> InlineKeyboardMarkup:
         ],
         [InlineKeyboardButton("⬅️ Назад к Presets", callback_data=f"{MENU_PREFIX}srv")],
     ])
-    
+
+@lru_cache(maxsize=None)
 def not_connected_kb(has_presets: bool) -> InlineKeyboardMarkup:
     rows = []
     if has_presets:
         rows.append([InlineKeyboardButton("🔗 Presets", callback_data=f"{MENU_PREFIX}srv")])
     rows.append([InlineKeyboardButton("ℹ️ Help", callback_data=f"{MENU_PREFIX}help")])
-    return InlineKeyboardMarkup(rows)
\ No newline at end of file
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=None)
+def del_all_confirm_kb() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton("Да, удалить всё", callback_data="delall:yes"),
+         InlineKeyboardButton("Отмена",          callback_data="delall:no")]
+    ])
@@ -1,3 +1,4 @@
+from functools import lru_cache
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 
 HELP_TEXT = (
@@ -40,17 +41,18 @@ HELP_TEXT = (
     "    • Удаляет маршрут по DID\n\n"
 )
 
-def _list_page_text(ip: str, pairs_page):
-    """Собрать текст для страницы списка EXT/паролей."""
-    if not pairs_page:
-        return f"{ip}\n\n(пусто)"
-    lines = [ip, ""]
-    lines += [f"{ext} {pw}" for ext, pw in pairs_page]
-    return "\n".join(lines)
+def _list_pages_text(ip: str, pairs, page_size: int):
+    """Все страницы списка EXT/паролей, собранные заранее: дальше навигация — просто индекс."""
+    if not pairs:
+        return [f"{ip}\n\n(пусто)"]
+    lines = [f"{ext} {pw}" for ext, pw in pairs]
+    head = f"{ip}\n\n"
+    return [head + "\n".join(lines[i:i + page_size]) for i in range(0, len(lines), page_size)]
 
 
+@lru_cache(maxsize=1024)
 def _list_nav_kb(page: int, pages: int):
-    """Построить клавиатуру навигации по страницам."""
+    """Построить клавиатуру навигации по страницам (кэшируется по (page, pages))."""
     prev_btn = InlineKeyboardButton("⬅️", callback_data=f"list:page:{page-1}")
     next_btn = InlineKeyboardButton("➡️", callback_data=f"list:page:{page+1}")
     nums = InlineKeyboardButton(f"{page+1}/{pages}", callback_data="noop")
@@ -67,6 +69,13 @@ MENU_WELCOME = (
     "Выбирайте раздел ниже — больше не нужно писать команды вручную."
 )
 
+# ответ команд без подключения (под ним — кнопка Presets)
+NEED_CONNECT = (
+    "❗️Сначала подключитесь:\n"
+    "<code>/connect &lt;host&gt; &lt;client_id&gt; &lt;client_secret&gt; [&lt;ssh_login&gt; &lt;ssh_password&gt;]</code>\n\n"
+    "…или откройте <b>Presets</b> ниже 👇"
+)
+
 NOT_CONNECTED = (
     "❗️Сначала подключитесь командой:\n"
     "<code>/connect &lt;host&gt; &lt;client_id&gt; &lt;client_secret&gt; [ssh_login] [ssh_password]</code>\n\n"
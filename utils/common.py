@@ -1,5 +1,5 @@
 import re
-from typing import List, Tuple
+from typing import Iterable, List, Tuple
 import hashlib
 import string
 from typing import Optional
@@ -7,29 +7,46 @@ import secrets
 
 PAGE_SIZE = 25
 
+_SCHEME_RE = re.compile(r"^https?://")
+# токен списка EXT: «401» или «401-418»
+_TARGET_TOKEN_RE = re.compile(r"\d+(-\d+)?")
+
 def clean_url(url: str) -> str:
-    return re.sub(r"^https?://", "", url).rstrip("/")
+    return _SCHEME_RE.sub("", url).rstrip("/")
+
+def is_target_token(tok: str) -> bool:
+    return _TARGET_TOKEN_RE.fullmatch(tok) is not None
 
 def equip_start(eq: int) -> int:
     return eq * 100 + 1
 
 def parse_targets(s: str) -> List[str]:
-    out: List[str] = []
-    for tok in s.strip().split():
+    nums = set()   # номера держим числами: диапазон разворачивается в C (set.update(range))
+    raw = set()    # токены не в канонической записи («0401») — как есть, как и раньше
+    for tok in s.split():
         if "-" in tok:
             a, b = tok.split("-", 1)
-            for n in range(int(a), int(b) + 1):
-                out.append(str(n))
+            nums.update(range(int(a), int(b) + 1))
+        elif tok.isdigit() and str(int(tok)) == tok:
+            nums.add(int(tok))
         else:
-            out.append(tok)
-    return sorted(set(out), key=lambda x: int(x))
+            raw.add(tok)
+    if raw:
+        return sorted(raw.union(map(str, nums)), key=int)
+    return list(map(str, sorted(nums)))
 
-def next_free(existing: List[str], start: int, count: int) -> List[str]:
-    taken = set(map(int, existing))
+def next_free(existing: Iterable[str], start: int, count: int) -> List[str]:
+    # существующие номера нужны только от start и выше: остальные не влияют на результат
+    nums = sorted({n for n in map(int, existing) if n >= start})
+    i = 0  # всё в nums не меньше start — идём с начала
     res, cur = [], start
     while len(res) < count:
-        if cur not in taken:
-            res.append(str(cur))
+        if i < len(nums) and nums[i] == cur:
+            # занятый номер — шагаем дальше по отсортированному списку
+            i += 1
+            cur += 1
+            continue
+        res.append(str(cur))
         cur += 1
     return res
 
@@ -40,13 +57,9 @@ def format_list(ip: str, pairs: List[Tuple[str, str]]) -> str:
     lines += [f"{ext} {pw}" for ext, pw in pairs]
     return "\n".join(lines)
 
-def _slice_pairs(pairs, page: int, page_size: int = PAGE_SIZE):
-    total = len(pairs)
-    pages = max(1, (total + page_size - 1) // page_size)
-    page = max(0, min(page, pages - 1))
-    start = page * page_size
-    end = start + page_size
-    return pairs[start:end], page, pages
+def _chunks(seq, size: int):
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
 
 def _profile_key(base_url: str, client_id: str) -> str:
     return hashlib.sha1(f"{base_url}|{client_id}".encode()).hexdigest()[:10]